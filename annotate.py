@@ -0,0 +1,253 @@
+import chess
+import chess.pgn
+import chess.polyglot
+import math
+import multiprocessing
+import os
+import sys
+import time
+from array import array
+from board import Board
+from smp import worker_init, worker_hash_mb
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# PGN annotation: games are streamed from the input with chess.pgn in
+# batches. The positions of a batch are collected by zobrist hash, those
+# that are not in the evaluation cache are searched (each only once, also
+# when it occurs in several games of the batch) with a time and/or node
+# budget in a pool of processes. Then the games are written with an
+# evaluation comment per move and ?!, ? and ?? marks (plus the better move
+# as a variation) for moves that lose too much. The cache is direct
+# mapped and keyed by the zobrist hash: positions that were seen in an
+# earlier batch (most of them in the opening) are not searched again.
+
+an_default_time = 500 # ms
+
+# allocated by run_annotate() only: main.py (and so every process it
+# spawns) imports this module
+an_cache_size = 1 << 20
+an_cache_keys = array('Q')
+an_cache_values = []
+
+# loss (centipawns, for the side that moved) from which on a move is
+# marked, worst first
+an_marks = [ (300, chess.pgn.NAG_BLUNDER), (100, chess.pgn.NAG_MISTAKE), (50, chess.pgn.NAG_DUBIOUS_MOVE) ]
+
+# mate and tablebase scores are clamped to this for the loss
+an_clamp = 1000
+
+def an_cache_init(size):
+    global an_cache_size, an_cache_keys, an_cache_values
+
+    an_cache_size = size
+    an_cache_keys = array('Q', [ 0 ]) * size
+    an_cache_values = [ None ] * size
+
+def an_cache_get(h):
+    idx = h % an_cache_size
+
+    if an_cache_keys[idx] == h:
+        return an_cache_values[idx]
+
+    return None
+
+def an_cache_put(h, entry):
+    idx = h % an_cache_size
+
+    an_cache_keys[idx] = h
+    an_cache_values[idx] = entry
+
+def an_search(board, max_time, max_nodes, max_depth):
+    """ (score for the side to move, best move or None, depth) """
+    from brain import calc_move, checkmate
+
+    if board.is_checkmate():
+        return (-checkmate, None, 0)
+
+    if board.is_game_over():
+        return (0, None, 0)
+
+    moves = list(board.legal_moves)
+
+    # calc_move() doesn't search a forced move
+    if len(moves) == 1:
+        board.push(moves[0])
+        score, move, depth = an_search(board, max_time, max_nodes, max_depth)
+        board.pop()
+
+        return (-score, moves[0], depth)
+
+    result = calc_move(board, max_time, max_depth, verbose=False, max_nodes=max_nodes)
+
+    return (result[0], result[1], result[2])
+
+def an_analyse_position(args):
+    """ runs in a pool process, returns (zobrist hash, entry); entry:
+        (white relative score, best move uci or None, depth) """
+    h, fen, max_time, max_nodes, max_depth = args
+
+    board = Board(fen)
+
+    score, move, depth = an_search(board, max_time, max_nodes, max_depth)
+
+    if board.turn == chess.BLACK:
+        score = -score
+
+    return (h, (score, move.uci() if move else None, depth))
+
+def an_format_score(score):
+    """ white relative, in pawns; a mate as # and a tablebase win as +- """
+    from brain import checkmate, tb_win
+
+    if abs(score) >= checkmate:
+        return '#' if score > 0 else '-#'
+
+    if abs(score) > tb_win - 1000:
+        return '+-' if score > 0 else '-+'
+
+    return '%+.2f' % (score / 100.0)
+
+def an_annotate_game(game, entries):
+    """ adds the comments, marks and variations to game """
+    node = game
+    board = game.board()
+
+    for i, m in enumerate(game.mainline_moves()):
+        before = entries[i]
+        after = entries[i + 1]
+
+        sign = 1 if board.turn == chess.WHITE else -1
+
+        child = node.variation(m)
+
+        loss = max(-an_clamp, min(an_clamp, sign * before[0])) - max(-an_clamp, min(an_clamp, sign * after[0]))
+
+        comment = '%s/%d' % (an_format_score(after[0]), after[2])
+
+        best = chess.Move.from_uci(before[1]) if before[1] else None
+
+        if best and best != m:
+            for threshold, nag in an_marks:
+                if loss >= threshold:
+                    child.nags.add(nag)
+
+                    if nag != chess.pgn.NAG_DUBIOUS_MOVE:
+                        comment += ' best %s' % board.san(best)
+                        if not node.has_variation(best):
+                            node.add_variation(best, comment='%s/%d' % (an_format_score(before[0]), before[2]))
+
+                    break
+
+        child.comment = (child.comment + ' ' + comment).strip()
+
+        board.push(m)
+        node = child
+
+    game.headers['Annotator'] = 'Feeks'
+
+def an_read_batch(fh, n):
+    games = []
+
+    while len(games) < n:
+        game = chess.pgn.read_game(fh)
+        if game == None:
+            break
+
+        games.append(game)
+
+    return games
+
+def run_annotate(file_, out_file=None, max_time=an_default_time, max_nodes=None, max_depth=999, processes=None):
+    """ max_time in ms; the annotated games go to out_file (or stdout,
+        then the progress is not shown). Returns the summary dict. """
+    if processes == None:
+        processes = os.cpu_count() or 1
+
+    processes = max(1, processes)
+
+    # games are read and written per batch so that memory use doesn't
+    # depend on the size of the input
+    batch_size = processes * 4
+
+    summary = { 'games' : 0, 'positions' : 0, 'searched' : 0 }
+
+    an_cache_init(an_cache_size)
+
+    out_fh = open(out_file, 'w') if out_file else sys.stdout
+
+    start = time.time()
+
+    ctx = multiprocessing.get_context('spawn')
+
+    with open(file_, 'r') as in_fh, ctx.Pool(processes, worker_init, (worker_hash_mb,)) as pool:
+        while True:
+            games = an_read_batch(in_fh, batch_size)
+            if not games:
+                break
+
+            # zobrist hash -> entry for all positions of the batch; kept
+            # apart from the cache where they could evict each other
+            entries = {}
+
+            jobs = []
+
+            for game in games:
+                board = game.board()
+
+                for m in list(game.mainline_moves()) + [ None ]:
+                    h = chess.polyglot.zobrist_hash(board)
+
+                    if not h in entries:
+                        entries[h] = an_cache_get(h)
+
+                        if entries[h] == None:
+                            jobs.append((h, board.fen(), max_time / 1000.0 if max_time else None, max_nodes, max_depth))
+
+                    if m:
+                        board.push(m)
+
+            # positions of a game are consecutive, a chunk of them on the
+            # same process keeps the transposition table useful
+            for h, entry in pool.imap_unordered(an_analyse_position, jobs, 8):
+                entries[h] = entry
+                an_cache_put(h, entry)
+
+            summary['searched'] += len(jobs)
+
+            for game in games:
+                board = game.board()
+                game_entries = []
+
+                for m in list(game.mainline_moves()) + [ None ]:
+                    game_entries.append(entries[chess.polyglot.zobrist_hash(board)])
+
+                    if m:
+                        board.push(m)
+
+                an_annotate_game(game, game_entries)
+
+                out_fh.write(str(game) + '\n\n')
+                out_fh.flush()
+
+                summary['games'] += 1
+                summary['positions'] += len(game_entries)
+
+                if out_file:
+                    print('game %d: %d positions' % (summary['games'], len(game_entries)))
+                    sys.stdout.flush()
+
+    if out_file:
+        out_fh.close()
+
+    summary['time_ms'] = int(math.ceil((time.time() - start) * 1000.0))
+
+    if out_file:
+        print('===========================')
+        print('Games           : %d' % summary['games'])
+        print('Positions       : %d' % summary['positions'])
+        print('Searched        : %d' % summary['searched'])
+        print('Total time (ms) : %d' % summary['time_ms'])
+
+    return summary
@@ -1,11 +1,19 @@
 import chess
 import chess.polyglot
 from chess.polyglot import POLYGLOT_RANDOM_ARRAY
+from psq import pmaterial_table, psq_color_table
+from log import l, LOG_ERROR
+
+# compare every incremental hash update against a full zobrist_hash()
+zh_verify = False
 
 class Board(chess.Board, object):
     def __init__(self, f=chess.STARTING_FEN, c=False):
         self._moves = []
         self._hashes = []
+        self._scores = []
+        self._pawn_hashes = []
+        self._checks = []
 
         super(Board, self).__init__(f)
 
@@ -21,31 +29,113 @@ class Board(chess.Board, object):
 
         return self._moves[-1]
 
+    def _get_check_info(self):
+        """ (king square, pinned pieces, evasions or None when not in
+            check) for the side to move; computed once per ply """
+        if not self._checks:
+            self._checks.append(None)
+
+        if not self._checks[-1]:
+            king = self.king(self.turn)
+            blockers = self._slider_blockers(king)
+            checkers = self.attackers_mask(not self.turn, king)
+
+            evasions = set(self._generate_evasions(king, checkers)) if checkers else None
+
+            self._checks[-1] = (king, blockers, evasions)
+
+        return self._checks[-1]
+
+    def is_legal_pseudo(self, m):
+        """ legality of a move that is known to be pseudo legal """
+        if self.king(self.turn) is None:
+            return True
+
+        king, blockers, evasions = self._get_check_info()
+
+        if evasions is not None and not m in evasions:
+            return False
+
+        return self._is_safe(king, blockers, m)
+
     def is_legal(self, m):
         if super(Board, self).is_pseudo_legal(m) == False:
             return False
 
-        return super(Board, self).is_legal(m) 
+        return self.is_legal_pseudo(m)
 
     def move_count(self):
         return len(self.get_move_list())
 
-    def _zh_remove_piece(self, square, hash_):
-        p = self.piece_at(square)
+    def _zh_piece(self, square, piece_type, color):
+        piece_index = (piece_type - 1) * 2 + int(color)
 
-        piece_index = (p.piece_type - 1) * 2 + int(p.color)
-        array_index = 64 * piece_index + square
+        return POLYGLOT_RANDOM_ARRAY[64 * piece_index + square]
 
-        return hash_ ^ POLYGLOT_RANDOM_ARRAY[array_index]
+    def _zh_swap_color(self, hash_):
+        return hash_ ^ POLYGLOT_RANDOM_ARRAY[780]
 
-    def _zh_put_piece(self, square, p, hash_):
-        piece_index = (p.piece_type - 1) * 2 + int(p.color)
-        array_index = 64 * piece_index + square
+    def _zh_castling(self, castling_rights):
+        # expects clean (standard chess) castling rights
+        hash_ = 0
+
+        if castling_rights & chess.BB_H1:
+            hash_ ^= POLYGLOT_RANDOM_ARRAY[768]
+        if castling_rights & chess.BB_A1:
+            hash_ ^= POLYGLOT_RANDOM_ARRAY[769]
+        if castling_rights & chess.BB_H8:
+            hash_ ^= POLYGLOT_RANDOM_ARRAY[770]
+        if castling_rights & chess.BB_A8:
+            hash_ ^= POLYGLOT_RANDOM_ARRAY[771]
+
+        return hash_
+
+    def _zh_ep(self):
+        # polyglot only hashes the en-passant file when a pawn of the side
+        # to move could capture
+        if not self.ep_square:
+            return 0
+
+        if self.turn == chess.WHITE:
+            ep_mask = chess.shift_down(chess.BB_SQUARES[self.ep_square])
+        else:
+            ep_mask = chess.shift_up(chess.BB_SQUARES[self.ep_square])
 
-        return hash_ ^ POLYGLOT_RANDOM_ARRAY[array_index]
+        ep_mask = chess.shift_left(ep_mask) | chess.shift_right(ep_mask)
 
-    def _zh_swap_color(self, hash_):
-        return hash_ ^ POLYGLOT_RANDOM_ARRAY[780]
+        if ep_mask & self.pawns & self.occupied_co[self.turn]:
+            return POLYGLOT_RANDOM_ARRAY[772 + chess.square_file(self.ep_square)]
+
+        return 0
+
+    def _update_hash(self, m, me, castling, hash_):
+        """ everything that can be done before the move is pushed """
+        color = self.turn
+
+        hash_ ^= self._zh_ep()
+
+        hash_ ^= self._zh_piece(m.from_square, me.piece_type, color)
+
+        if castling:
+            king_to, rook_from, rook_to = self._castling_squares(m)
+
+            hash_ ^= self._zh_piece(king_to, chess.KING, color)
+            hash_ ^= self._zh_piece(rook_from, chess.ROOK, color)
+            hash_ ^= self._zh_piece(rook_to, chess.ROOK, color)
+
+        else:
+            if me.piece_type == chess.PAWN and m.to_square == self.ep_square:
+                victim_square = m.to_square - 8 if color == chess.WHITE else m.to_square + 8
+                hash_ ^= self._zh_piece(victim_square, chess.PAWN, not color)
+
+            else:
+                victim_type = self.piece_type_at(m.to_square)
+                if victim_type:
+                    hash_ ^= self._zh_piece(m.to_square, victim_type, not color)
+
+            hash_ ^= self._zh_piece(m.to_square, m.promotion or me.piece_type, color)
+
+        return self._zh_swap_color(hash_)
 
     def get_zh(self):
         if len(self._hashes) == 0:
@@ -53,53 +143,150 @@ class Board(chess.Board, object):
 
         return self._hashes[-1]
 
+    def _calc_pawn_zh(self):
+        hash_ = 0
+
+        for color in (chess.WHITE, chess.BLACK):
+            for sq in chess.scan_forward(self.pawns & self.occupied_co[color]):
+                hash_ ^= self._zh_piece(sq, chess.PAWN, color)
+
+        return hash_
+
+    def get_pawn_zh(self):
+        """ zobrist key of only the pawns, for the pawn hash """
+        if len(self._pawn_hashes) == 0:
+            self._pawn_hashes.append(self._calc_pawn_zh())
+
+        return self._pawn_hashes[-1]
+
+    def _update_pawn_hash(self, m, me, pawn_hash):
+        color = self.turn
+
+        if me.piece_type == chess.PAWN:
+            pawn_hash ^= self._zh_piece(m.from_square, chess.PAWN, color)
+
+            if m.to_square == self.ep_square:
+                victim_square = m.to_square - 8 if color == chess.WHITE else m.to_square + 8
+                pawn_hash ^= self._zh_piece(victim_square, chess.PAWN, not color)
+
+            if not m.promotion:
+                pawn_hash ^= self._zh_piece(m.to_square, chess.PAWN, color)
+
+        if self.pawns & chess.BB_SQUARES[m.to_square]:
+            pawn_hash ^= self._zh_piece(m.to_square, chess.PAWN, not color)
+
+        return pawn_hash
+
+    def _calc_scores(self):
+        # (material black, material white, psq black, psq white)
+        s = [ 0, 0, 0, 0 ]
+
+        for sq, p in self.piece_map().items():
+            s[p.color] += pmaterial_table[p.piece_type]
+            s[2 + p.color] += psq_color_table[p.color][p.piece_type][sq]
+
+        return tuple(s)
+
+    def get_scores(self):
+        if len(self._scores) == 0:
+            self._scores.append(self._calc_scores())
+
+        return self._scores[-1]
+
+    def _castling_squares(self, m):
+        # (king to, rook from, rook to)
+        rank = m.from_square & 56
+
+        if chess.square_file(m.to_square) < chess.square_file(m.from_square):
+            return (rank + 2, rank + 0, rank + 3)
+
+        return (rank + 6, rank + 7, rank + 5)
+
+    def _update_scores(self, m, me, castling, scores):
+        s = list(scores)
+
+        color = self.turn
+        them = not color
+        table = psq_color_table[color]
+
+        if castling:
+            king_to, rook_from, rook_to = self._castling_squares(m)
+
+            s[2 + color] += table[chess.KING][king_to] - table[chess.KING][m.from_square]
+            s[2 + color] += table[chess.ROOK][rook_to] - table[chess.ROOK][rook_from]
+
+            return tuple(s)
+
+        s[2 + color] -= table[me.piece_type][m.from_square]
+
+        if m.promotion:
+            s[color] += pmaterial_table[m.promotion] - pmaterial_table[chess.PAWN]
+            s[2 + color] += table[m.promotion][m.to_square]
+
+        else:
+            s[2 + color] += table[me.piece_type][m.to_square]
+
+        if me.piece_type == chess.PAWN and m.to_square == self.ep_square:
+            victim_square = m.to_square - 8 if color == chess.WHITE else m.to_square + 8
+            victim_type = chess.PAWN
+
+        else:
+            victim_square = m.to_square
+            victim_type = self.piece_type_at(m.to_square)
+
+        if victim_type:
+            s[them] -= pmaterial_table[victim_type]
+            s[2 + them] -= psq_color_table[them][victim_type][victim_square]
+
+        return tuple(s)
+
     def push(self, m):
-        #print(self.fen(), m)
+        hash_ = self._hashes[-1] if len(self._hashes) else chess.polyglot.zobrist_hash(self)
+        scores = self._scores[-1] if len(self._scores) else self._calc_scores()
+        pawn_hash = self._pawn_hashes[-1] if len(self._pawn_hashes) else self._calc_pawn_zh()
 
-        me = self.piece_at(m.from_square)
+        castling_rights = self.clean_castling_rights() if self.castling_rights else 0
 
-        force = False
         if m == chess.Move.null():
             # no null move at root
-            hash_ = self._hashes[-1] if len(self._hashes) else chess.polyglot.zobrist_hash(self)
-            hash_ = self._zh_swap_color(hash_)
-
-        elif self.is_en_passant(m) or self.is_castling(m) or me.piece_type == chess.KING or me.piece_type == chess.ROOK:
-            force = True
+            hash_ = self._zh_swap_color(hash_ ^ self._zh_ep())
 
         else:
-            hash_ = self._hashes[-1] if len(self._hashes) else chess.polyglot.zobrist_hash(self)
-            #print('\t\t', hash_ == None or hash_ == chess.polyglot.zobrist_hash(self))
+            me = self.piece_at(m.from_square)
+            castling = me.piece_type == chess.KING and self.is_castling(m)
 
-            victim = self.piece_at(m.to_square)
-            if victim:
-                #print 'regular capture'
-                hash_ = self._zh_remove_piece(m.to_square, hash_)
-            else:
-                #print 'regular move'
-                pass
+            hash_ = self._update_hash(m, me, castling, hash_)
+            scores = self._update_scores(m, me, castling, scores)
+
+            if not castling:
+                pawn_hash = self._update_pawn_hash(m, me, pawn_hash)
 
-            hash_ = self._zh_remove_piece(m.from_square, hash_)
+        super(Board, self).push(m)
 
-            hash_ = self._zh_put_piece(m.to_square, me, hash_)
+        new_castling_rights = self.clean_castling_rights() if self.castling_rights else 0
 
-            hash_ = self._zh_swap_color(hash_)
+        if castling_rights != new_castling_rights:
+            hash_ ^= self._zh_castling(castling_rights) ^ self._zh_castling(new_castling_rights)
 
-        super(Board, self).push(m)
+        hash_ ^= self._zh_ep()
 
-        if force:
-            hash_ = chess.polyglot.zobrist_hash(self)
+        if zh_verify and hash_ != chess.polyglot.zobrist_hash(self):
+            l('zobrist mismatch after %s: %x %x (%s)', m, hash_, chess.polyglot.zobrist_hash(self), self.fen(), level=LOG_ERROR)
 
-        #print('\t\t', hash_ == None or hash_ == chess.polyglot.zobrist_hash(self))
+            hash_ = chess.polyglot.zobrist_hash(self)
 
         self._moves.append(None)
+        self._checks.append(None)
         self._hashes.append(hash_)
-
-        #print(len(self._hashes), len(self._moves) == len(self._hashes))
+        self._scores.append(scores)
+        self._pawn_hashes.append(pawn_hash)
 
     def pop(self):
         del self._moves[-1]
+        del self._checks[-1]
         del self._hashes[-1]
+        del self._scores[-1]
+        del self._pawn_hashes[-1]
 
         return super(Board, self).pop()
 
@@ -108,7 +295,10 @@ class Board(chess.Board, object):
 
     def _clear(self):
         self._moves = []
+        self._checks = []
         self._hashes = []
+        self._scores = []
+        self._pawn_hashes = []
 
     def copy(self):
         c = super(Board, self).copy()
@@ -137,3 +327,16 @@ if __name__ == "__main__":
     print(b.get_zh(), chess.polyglot.zobrist_hash(b), b.get_zh() == chess.polyglot.zobrist_hash(b))
     b.push(chess.Move.from_uci('e5d4'))
     print(b.get_zh(), chess.polyglot.zobrist_hash(b), b.get_zh() == chess.polyglot.zobrist_hash(b))
+
+    print('---')
+
+    # castling, en passant and promotion
+    for fen, moves in [ ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', [ 'e1g1', 'e8c8' ]),
+                        ('r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1', [ 'h1h8', 'e8d7', 'a1a8' ]),
+                        ('rnbqkbnr/ppp1pppp/8/8/3p4/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1', [ 'e2e4', 'd4e3', 'f2e3' ]),
+                        ('4k3/1P6/8/8/8/8/6p1/4K2R b K - 0 1', [ 'g2h1q', 'b7b8n' ]) ]:
+        b = Board(fen)
+
+        for m in moves:
+            b.push(chess.Move.from_uci(m))
+            print(m, b.get_zh(), chess.polyglot.zobrist_hash(b), b.get_zh() == chess.polyglot.zobrist_hash(b))
@@ -0,0 +1,127 @@
+import chess
+import mmap
+import random
+import struct
+from log import l
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Polyglot opening book. The file is memory mapped and, as its entries
+# are sorted by key, searched with a binary search on Board.get_zh().
+#
+# entry (16 bytes, big endian): key 64 bits, move 16 bits, weight 16
+# bits, learn 32 bits. move: to 6 bits, from 6 bits, promotion 3 bits
+# (1 = knight ... 4 = queen); castling is encoded as king takes rook.
+
+book_entry = struct.Struct('>QHHI')
+
+book_fh = None
+book_mm = None
+book_n = 0
+
+def book_close():
+    global book_fh, book_mm, book_n
+
+    if book_mm:
+        book_mm.close()
+        book_mm = None
+
+    if book_fh:
+        book_fh.close()
+        book_fh = None
+
+    book_n = 0
+
+def book_open(path):
+    """ an empty path (or '<empty>') only closes the current book """
+    global book_fh, book_mm, book_n
+
+    book_close()
+
+    if not path or path == '<empty>':
+        return False
+
+    try:
+        book_fh = open(path, 'rb')
+        book_mm = mmap.mmap(book_fh.fileno(), 0, access=mmap.ACCESS_READ)
+        book_n = len(book_mm) // book_entry.size
+
+    except Exception as e:
+        l('cannot open book %s: %s', path, e)
+        book_close()
+        return False
+
+    l('opened book %s, %d entries', path, book_n)
+
+    return True
+
+def book_key_at(i):
+    return book_entry.unpack_from(book_mm, i * book_entry.size)[0]
+
+def book_entries(key):
+    """ (move, weight) of all entries for key """
+    lo = 0
+    hi = book_n
+
+    while lo < hi:
+        mid = (lo + hi) // 2
+
+        if book_key_at(mid) < key:
+            lo = mid + 1
+        else:
+            hi = mid
+
+    out = []
+
+    while lo < book_n:
+        k, move, weight, learn = book_entry.unpack_from(book_mm, lo * book_entry.size)
+        if k != key:
+            break
+
+        out.append((move, weight))
+        lo += 1
+
+    return out
+
+def book_decode_move(board, v):
+    to_sq = v & 63
+    from_sq = (v >> 6) & 63
+    promotion = (v >> 12) & 7
+
+    m = chess.Move(from_sq, to_sq, promotion + 1 if promotion else None)
+
+    # king takes own rook -> regular castling notation
+    if board.piece_type_at(from_sq) == chess.KING and board.piece_type_at(to_sq) == chess.ROOK and board.color_at(to_sq) == board.turn:
+        m = chess.Move(from_sq, chess.square(6 if to_sq > from_sq else 2, chess.square_rank(from_sq)))
+
+    return m
+
+def book_probe(board):
+    """ a weighted random book move or None """
+    if not book_mm:
+        return None
+
+    candidates = []
+    total = 0
+
+    for v, weight in book_entries(board.get_zh()):
+        m = book_decode_move(board, v)
+
+        if weight > 0 and board.is_legal(m):
+            candidates.append((m, weight))
+            total += weight
+
+    if not candidates:
+        return None
+
+    r = random.randrange(total)
+
+    for m, weight in candidates:
+        if r < weight:
+            l('book move %s (weight %d of %d)', m, weight, total)
+            return m
+
+        r -= weight
+
+    return None
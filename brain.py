@@ -3,12 +3,15 @@
 # (C) 2017 by folkert@vanheusden.com
 # released under AGPL v3.0
 
+from array import array
 import chess
 import chess.pgn
-import collections
-from psq import psq, psq_individual
-from tt import tt_inc_age, tt_store, tt_lookup, tt_get_pv
-from log import l
+from psq import pmaterial_table
+from tt import tt_inc_age, tt_store, tt_lookup, tt_hashfull, TT_EXACT, TT_LOWER, TT_UPPER
+from log import l, l_enabled, LOG_DEBUG, LOG_ERROR
+from smp import smp_search_start, smp_search_stop
+from tb import tb_probe_wdl, tb_root_moves
+from timeman import tm_start_search, tm_iteration_done, tm_ponderhit, SearchLimits
 import math
 import operator
 import sys
@@ -21,23 +24,51 @@ with_qs = True
 stats_node_count = 0
 stats_tt_checks = stats_tt_hits = 0
 stats_avg_bco_index_cnt = stats_avg_bco_index = 0
+stats_ph_checks = stats_ph_hits = 0
+stats_ec_hits = stats_ec_misses = 0
+stats_tb_hits = 0
 
 infinite = 131072
 checkmate = 10000
-
-pmaterial_table = [ 0 ] * (6 + 1)
-pmaterial_table[chess.PAWN] = 100
-pmaterial_table[chess.KNIGHT] = 325
-pmaterial_table[chess.BISHOP] = 325
-pmaterial_table[chess.ROOK] = 500
-pmaterial_table[chess.QUEEN] = 975
-pmaterial_table[chess.KING] = 10000
-
-to_flag = None
-
-def set_to_flag(to_flag):
-    to_flag.set()
-    l("time is up");
+tb_win = checkmate - 1000
+
+double_pawn_penalty = 10
+rook_open_file_bonus = 10
+
+# pawn hash: direct mapped, indexed by Board.get_pawn_zh()
+ph_size = 16384
+ph_keys = array('Q', [ 0 ]) * ph_size
+ph_passed = array('i', [ 0 ]) * ph_size
+ph_double = array('i', [ 0 ]) * ph_size
+ph_files = array('H', [ 0 ]) * ph_size
+
+# move ordering: butterfly history [color][from * 64 + to], counter
+# moves [color][previous from * 64 + previous to] and 2 killer moves per
+# ply
+max_ply = 256
+history_max = 1 << 20
+
+history = [ [ 0 ] * 4096, [ 0 ] * 4096 ]
+countermoves = [ [ None ] * 4096, [ None ] * 4096 ]
+killers = [ [ None, None ] for i in range(0, max_ply) ]
+
+# triangular principal variation array: the pv found at ply p is stored
+# in pv_table[p * max_ply + p] .. pv_table[p * max_ply + pv_length[p] - 1]
+pv_table = [ None ] * (max_ply * max_ply)
+pv_length = [ 0 ] * (max_ply + 1)
+
+# evaluation cache: direct mapped, indexed by Board.get_zh(), holds the
+# side-relative static score
+ec_size = 0
+ec_keys = array('Q')
+ec_scores = array('d')
+ec_entry_bytes = 16
+ec_default_mb = 8
+
+limits = SearchLimits()
+
+# root moves that keep the tablebase result (None: all)
+root_filter = None
 
 def get_stats():
     global stats_avg_bco_index, stats_node_count, stats_tt_hits, stats_tt_checks
@@ -46,7 +77,12 @@ def get_stats():
         'stats_tt_hits' : stats_tt_hits,
         'stats_tt_checks' : stats_tt_checks,
         'stats_avg_bco_index_cnt' : stats_avg_bco_index_cnt,
-        'stats_avg_bco_index' : stats_avg_bco_index
+        'stats_avg_bco_index' : stats_avg_bco_index,
+        'stats_ph_checks' : stats_ph_checks,
+        'stats_ph_hits' : stats_ph_hits,
+        'stats_ec_hits' : stats_ec_hits,
+        'stats_ec_misses' : stats_ec_misses,
+        'stats_tb_hits' : stats_tb_hits
         }
 
 def reset_stats():
@@ -54,8 +90,8 @@ def reset_stats():
 
     stats_avg_bco_index_cnt = stats_avg_bco_index = stats_node_count = stats_tt_checks = stats_tt_hits = 0
 
-def material(pm):
-    return sum((1 if pm[p].color else -1) * pmaterial_table[pm[p].piece_type] for p in pm)
+    global stats_ph_checks, stats_ph_hits, stats_ec_hits, stats_ec_misses, stats_tb_hits
+    stats_ph_checks = stats_ph_hits = stats_ec_hits = stats_ec_misses = stats_tb_hits = 0
 
 def mobility(board):
     if board.turn:
@@ -74,99 +110,147 @@ def mobility(board):
 
     return white_n - black_n
 
-def pm_to_filemap(piece_map):
-    files = [ 0 ] * (8 * 7 * 2)
+# passed_span[color][square]: the squares in front of a pawn on its own
+# and on the adjacent files. No enemy pawns there means it is passed.
+passed_span = [ [ 0 ] * 64, [ 0 ] * 64 ]
 
-    for p, piece in piece_map.items():
-        files[piece.color * 8 * 7 + piece.piece_type * 8 + (p & 7)] += 1
+for sq in range(0, 64):
+    x = sq & 7
+    y = sq >> 3
 
-    return files
+    span_files = chess.BB_FILES[x]
+    if x > 0:
+        span_files |= chess.BB_FILES[x - 1]
+    if x < 7:
+        span_files |= chess.BB_FILES[x + 1]
 
-def count_double_pawns(file_map):
-    n = 0
+    passed_span[chess.WHITE][sq] = span_files & (chess.BB_ALL << (8 * (y + 1))) & chess.BB_ALL
+    passed_span[chess.BLACK][sq] = span_files & ((1 << (8 * y)) - 1)
 
-    for i in range(0, 8):
-        if file_map[chess.WHITE * 8 * 7 + chess.PAWN * 8 + i] >= 2:
-            n += file_map[chess.WHITE * 8 * 7 + chess.PAWN * 8 + i] - 1
+passed_scores = [ [ 0, 5, 20, 30, 40, 50, 80, 0 ], [ 0, 5, 20, 40, 70, 120, 200, 0 ] ]
 
-        if file_map[chess.BLACK * 8 * 7 + chess.PAWN * 8 + i] >= 2:
-            n -= file_map[chess.BLACK * 8 * 7 + chess.PAWN * 8 + i] - 1
+def bb_to_files(bb):
+    """ 8 bit mask of the files that have at least one bit set in bb """
+    bb |= bb >> 32
+    bb |= bb >> 16
+    bb |= bb >> 8
 
-    return n
+    return bb & 0xff
 
-def count_rooks_on_open_file(file_map):
-    n = 0
+def count_double_pawns(white_pawns, black_pawns):
+    # every pawn on a file beyond the first one
+    n = chess.popcount(white_pawns) - chess.popcount(bb_to_files(white_pawns))
+    n -= chess.popcount(black_pawns) - chess.popcount(bb_to_files(black_pawns))
 
-    for i in range(0, 8):
-        if file_map[chess.WHITE * 8 * 7 + chess.PAWN * 8 + i] == 0 and file_map[chess.WHITE * 8 * 7 + chess.ROOK * 8 + i] > 0:
-            n += 1
+    return n
+
+def count_rooks_on_open_file(board, pawn_files):
+    """ pawn_files: files with white pawns | files with black pawns << 8 """
+    white_rooks = bb_to_files(board.rooks & board.occupied_co[chess.WHITE])
+    black_rooks = bb_to_files(board.rooks & board.occupied_co[chess.BLACK])
 
-        if file_map[chess.BLACK * 8 * 7 + chess.PAWN * 8 + i] == 0 and file_map[chess.BLACK * 8 * 7 + chess.ROOK * 8 + i] > 0:
-            n -= 1
+    n = chess.popcount(white_rooks & ~pawn_files & 0xff)
+    n -= chess.popcount(black_rooks & ~(pawn_files >> 8) & 0xff)
 
     return n
 
-def passed_pawn(pm, is_end_game):
-    whiteYmax = [ -1 ] * 8
-    blackYmin = [ 8 ] * 8
+def passed_pawn(white_pawns, black_pawns, is_end_game):
+    scores = passed_scores[is_end_game]
 
-    for key, p in pm.items():
-        if p.piece_type != chess.PAWN:
-            continue
+    score = 0
 
-        x = key & 7
-        y = key >> 3
+    for sq in chess.scan_forward(white_pawns):
+        if not passed_span[chess.WHITE][sq] & black_pawns:
+            score += scores[sq >> 3]
 
-        if p.color == chess.WHITE:
-            whiteYmax[x] = max(whiteYmax[x], y)
-        else:
-            blackYmin[x] = min(blackYmin[x], y)
+    for sq in chess.scan_forward(black_pawns):
+        if not passed_span[chess.BLACK][sq] & white_pawns:
+            score -= scores[7 - (sq >> 3)]
 
-    scores = [ [ 0, 5, 20, 30, 40, 50, 80, 0 ], [ 0, 5, 20, 40, 70, 120, 200, 0 ] ]
+    return score
 
-    score = 0
+def pawn_structure(board):
+    """ (passed pawn score, doubled pawns, pawn files), cached in the
+        pawn hash """
+    global stats_ph_checks, stats_ph_hits
+    stats_ph_checks += 1
 
-    for key, p in pm.items():
-        if p.piece_type != chess.PAWN:
-            continue
+    h = board.get_pawn_zh()
+    idx = h % ph_size
 
-        x = key & 7
-        y = key >> 3
+    if ph_keys[idx] == h:
+        stats_ph_hits += 1
 
-        if p.color == chess.WHITE:
-            left = (x > 0 and (blackYmin[x - 1] <= y or blackYmin[x - 1] == 8)) or x == 0;
-            front = blackYmin[x] < y or blackYmin[x] == 8;
-            right = (x < 7 and (blackYmin[x + 1] <= y or blackYmin[x + 1] == 8)) or x == 7;
+        return (ph_passed[idx], ph_double[idx], ph_files[idx])
 
-            if left and front and right:
-                score += scores[is_end_game][y];
+    white_pawns = board.pawns & board.occupied_co[chess.WHITE]
+    black_pawns = board.pawns & board.occupied_co[chess.BLACK]
 
-        else:
-            left = (x > 0 and (whiteYmax[x - 1] >= y or whiteYmax[x - 1] == -1)) or x == 0;
-            front = whiteYmax[x] > y or whiteYmax[x] == -1;
-            right = (x < 7 and (whiteYmax[x + 1] >= y or whiteYmax[x + 1] == -1)) or x == 7;
+    passed = passed_pawn(white_pawns, black_pawns, False) # FIXME
 
-            if left and front and right:
-                score -= scores[is_end_game][7 - y];
+    double = count_double_pawns(white_pawns, black_pawns)
 
-    return score
+    files = bb_to_files(white_pawns) | (bb_to_files(black_pawns) << 8)
+
+    ph_keys[idx] = h
+    ph_passed[idx] = passed
+    ph_double[idx] = double
+    ph_files[idx] = files
+
+    return (passed, double, files)
+
+def ec_init(size_mb):
+    global ec_size, ec_keys, ec_scores
+
+    ec_size = max(1, size_mb * 1024 * 1024 // ec_entry_bytes)
+
+    l('Set evaluation cache size to %d MB, %d entries', size_mb, ec_size)
+
+    # release the old table before allocating the new one
+    ec_keys = array('Q')
+    ec_scores = array('d')
+
+    ec_keys = array('Q', [ 0 ]) * ec_size
+    ec_scores = array('d', [ 0.0 ]) * ec_size
+
+ec_init(ec_default_mb)
 
 def evaluate(board):
-    pm = board.piece_map()
+    global stats_ec_hits, stats_ec_misses
+
+    h = board.get_zh()
+    idx = h % ec_size
+
+    if ec_keys[idx] == h:
+        stats_ec_hits += 1
+
+        return ec_scores[idx]
+
+    stats_ec_misses += 1
 
-    score = material(pm)
+    score = evaluate_uncached(board)
 
-    score += psq(pm) / 4
+    ec_keys[idx] = h
+    ec_scores[idx] = score
+
+    return score
+
+def evaluate_uncached(board):
+    mat_b, mat_w, psq_b, psq_w = board.get_scores()
+
+    score = mat_w - mat_b
+
+    score += (psq_w - psq_b) / 4
 
 #    score += mobility(board) * 10
 
-    score += passed_pawn(pm, False) # FIXME
+    passed, double, pawn_files = pawn_structure(board)
 
-#    pfm = pm_to_filemap(pm)
+    score += passed
 
-#    score += count_double_pawns(pfm)
+    score -= double * double_pawn_penalty
 
-#    score += count_rooks_on_open_file(pfm)
+    score += count_rooks_on_open_file(board, pawn_files) * rook_open_file_bonus
 
     if board.turn:
         return score
@@ -180,35 +264,241 @@ class pc_move(object):
         self.score = score
         self.move = move
 
-def victim_type_for_move(board, m):
-    if board.is_en_passant(m):
-        return chess.PAWN
+# mvv_lva[victim][attacker]
+mvv_lva = [ [ 0 ] * (6 + 1) for i in range(0, 6 + 1) ]
 
-    return board.piece_type_at(m.to_square)
+for victim_type in range(chess.PAWN, chess.KING + 1):
+    for attacker_type in range(chess.PAWN, chess.KING + 1):
+        mvv_lva[victim_type][attacker_type] = (pmaterial_table[victim_type] << 18) + ((pmaterial_table[chess.QUEEN] - pmaterial_table[attacker_type]) << 8)
 
-def pc_to_list(board, moves_first):
-    out = []
+def score_tactical(board, m):
+    score = 0
 
-    for m in board.get_move_list():
-        c = pc_move(0, m)
+    if m.promotion:
+        score += pmaterial_table[m.promotion] << 18
+
+    victim_type = board.piece_type_at(m.to_square)
+    if victim_type == None and m.to_square == board.ep_square and board.piece_type_at(m.from_square) == chess.PAWN:
+        victim_type = chess.PAWN
+
+    if victim_type:
+        score += mvv_lva[victim_type][board.piece_type_at(m.from_square)]
+
+    return score
+
+def attackers_to(board, square, occupied):
+    """ pieces of both colors attacking square when only the pieces in
+        occupied are on the board, so sliders behind a piece that was
+        removed from occupied (x-rays) are included """
+    queens_and_rooks = board.queens | board.rooks
+    queens_and_bishops = board.queens | board.bishops
+
+    attackers = (chess.BB_KING_ATTACKS[square] & board.kings) | \
+        (chess.BB_KNIGHT_ATTACKS[square] & board.knights) | \
+        (chess.BB_RANK_ATTACKS[square][chess.BB_RANK_MASKS[square] & occupied] & queens_and_rooks) | \
+        (chess.BB_FILE_ATTACKS[square][chess.BB_FILE_MASKS[square] & occupied] & queens_and_rooks) | \
+        (chess.BB_DIAG_ATTACKS[square][chess.BB_DIAG_MASKS[square] & occupied] & queens_and_bishops) | \
+        (chess.BB_PAWN_ATTACKS[chess.BLACK][square] & board.pawns & board.occupied_co[chess.WHITE]) | \
+        (chess.BB_PAWN_ATTACKS[chess.WHITE][square] & board.pawns & board.occupied_co[chess.BLACK])
+
+    return attackers & occupied
+
+def see(board, m):
+    """ static exchange evaluation of a capture or promotion, in
+        centipawns from the view of the side making the move """
+    to_square = m.to_square
+    occupied = board.occupied ^ chess.BB_SQUARES[m.from_square]
+
+    piece = board.piece_type_at(m.from_square)
+
+    victim_type = board.piece_type_at(to_square)
+    if victim_type == None and piece == chess.PAWN and to_square == board.ep_square:
+        victim_type = chess.PAWN
+        occupied ^= chess.BB_SQUARES[to_square - 8 if board.turn == chess.WHITE else to_square + 8]
+
+    gain = [ pmaterial_table[victim_type] if victim_type else 0 ]
+
+    if m.promotion:
+        gain[0] += pmaterial_table[m.promotion] - pmaterial_table[chess.PAWN]
+        piece = m.promotion
+
+    color = not board.turn
+    attackers = attackers_to(board, to_square, occupied)
+
+    while True:
+        side_attackers = attackers & board.occupied_co[color]
+        if not side_attackers:
+            break
+
+        # least valuable attacker
+        for attacker_type in range(chess.PAWN, chess.KING + 1):
+            bb = side_attackers & board.pieces_mask(attacker_type, color)
+            if bb:
+                break
+
+        # the king can't capture into an attacked square
+        if attacker_type == chess.KING and attackers & board.occupied_co[not color]:
+            break
+
+        gain.append(pmaterial_table[piece] - gain[-1])
+
+        occupied ^= bb & -bb
+        attackers = attackers_to(board, to_square, occupied)
+
+        piece = attacker_type
+        color = not color
+
+    for d in range(len(gain) - 1, 0, -1):
+        gain[d - 1] = -max(-gain[d - 1], gain[d])
+
+    return gain[0]
+
+def gen_captures(board):
+    """ captures (including en-passant) and promotions. returns the
+        winning/equal ones (mvv-lva order) and the ones losing material
+        according to see (best first) """
+    good = []
+    bad = []
+
+    for m in board.generate_pseudo_legal_captures():
+        victim_type = board.piece_type_at(m.to_square) or chess.PAWN
+
+        # see can only be negative when the piece is worth more than the victim
+        if pmaterial_table[board.piece_type_at(m.from_square)] > pmaterial_table[victim_type] and not m.promotion:
+            see_score = see(board, m)
+
+            if see_score < 0:
+                bad.append(pc_move(see_score, m))
+                continue
+
+        good.append(pc_move(score_tactical(board, m), m))
+
+    # non-capturing promotions
+    for m in board.generate_pseudo_legal_moves(board.pawns, (chess.BB_RANK_1 | chess.BB_RANK_8) & ~board.occupied):
+        see_score = see(board, m)
+
+        if see_score < 0:
+            bad.append(pc_move(see_score, m))
+
+        else:
+            good.append(pc_move(score_tactical(board, m), m))
+
+    good.sort(key=operator.attrgetter('score'), reverse = True)
+    bad.sort(key=operator.attrgetter('score'), reverse = True)
+
+    return (good, bad)
+
+def is_quiet(board, m):
+    if m.promotion or board.piece_type_at(m.to_square) != None:
+        return False
+
+    return not (m.to_square == board.ep_square and board.piece_type_at(m.from_square) == chess.PAWN)
+
+def history_age(shift):
+    for color in (chess.WHITE, chess.BLACK):
+        h = history[color]
+
+        for i in range(0, 4096):
+            h[i] >>= shift
+
+def history_clear():
+    for color in (chess.WHITE, chess.BLACK):
+        history[color] = [ 0 ] * 4096
+        countermoves[color] = [ None ] * 4096
+
+    for k in killers:
+        k[0] = k[1] = None
+
+def history_update(board, m, depth, tried_quiets, ply):
+    """ m is the quiet move that caused a beta cut-off """
+    color = board.turn
+    h = history[color]
+
+    bonus = min(depth * depth, history_max)
+
+    # gravity: the closer an entry is to +/- history_max, the less it
+    # moves in that direction, so entries stay within those bounds
+    idx = m.from_square * 64 + m.to_square
+    h[idx] += bonus - h[idx] * bonus // history_max
+
+    for q in tried_quiets:
+        idx = q.from_square * 64 + q.to_square
+        h[idx] += -bonus - h[idx] * bonus // history_max
+
+    if ply < max_ply and killers[ply][0] != m:
+        killers[ply][1] = killers[ply][0]
+        killers[ply][0] = m
+
+    if board.move_stack:
+        prev = board.move_stack[-1]
+
+        if prev:
+            countermoves[color][prev.from_square * 64 + prev.to_square] = m
+
+def get_countermove(board):
+    if not board.move_stack:
+        return None
+
+    prev = board.move_stack[-1]
+    if not prev:
+        return None
+
+    return countermoves[board.turn][prev.from_square * 64 + prev.to_square]
+
+def gen_moves(board, tt_move, ply_killers, counter, with_quiets):
+    """ staged move picker: every stage is only generated when the
+        search gets there """
+    if tt_move and board.is_pseudo_legal(tt_move):
+        yield tt_move
+
+    else:
+        tt_move = None
+
+    good, bad = gen_captures(board)
+
+    for c in good:
+        if c.move != tt_move:
+            yield c.move
+
+    # quiescence search does not look at captures that lose material
+    if not with_quiets:
+        return
+
+    done = [ tt_move ]
+    for m in ply_killers + [ counter ]:
+        if m and not m in done and is_quiet(board, m) and board.is_pseudo_legal(m):
+            done.append(m)
+            yield m
+
+    h = history[board.turn]
+
+    quiets = []
+    for m in board.generate_pseudo_legal_moves(chess.BB_ALL, ~board.occupied_co[not board.turn]):
+        if m in done or not is_quiet(board, m):
+            continue
+
+        quiets.append(pc_move(h[m.from_square * 64 + m.to_square], m))
 
-        if m.promotion:
-            c.score += pmaterial_table[m.promotion] << 18
+    quiets.sort(key=operator.attrgetter('score'), reverse = True)
 
-        if board.is_capture(m): # FIXME
-            victim_type = victim_type_for_move(board, m)
-            c.score += pmaterial_table[victim_type] << 18
+    for c in quiets:
+        yield c.move
 
-            me = board.piece_at(m.from_square)
-            c.score += (pmaterial_table[chess.QUEEN] - pmaterial_table[me.piece_type]) << 8
+    for c in bad:
+        if c.move != tt_move:
+            yield c.move
+
+def pc_to_list(board, moves_first):
+    out = []
+
+    for m in board.get_move_list():
+        out.append(pc_move(score_tactical(board, m), m))
 
         # -20 elo: 
         #else:
         #	me = board.piece_at(m.from_square)
         #	score += psq_individual(m.to_square, me) - psq_individual(m.from_square, me)
 
-        out.append(c)
-
     for i in range(0, len(moves_first)):
         for m in out:
             if m.move == moves_first[i]:
@@ -219,15 +509,6 @@ def pc_to_list(board, moves_first):
 
     return out
 
-def blind(board, m):
-    victim_type = victim_type_for_move(board, m)
-    victim_eval = pmaterial_table[victim_type]
-
-    me_type = board.piece_type_at(m.from_square)
-    me_eval = pmaterial_table[me_type]
-
-    return victim_eval < me_eval and board.attackers(not board.turn, m.to_square)
-
 def is_draw(board):
     if board.halfmove_clock >= 100:
         return True
@@ -237,11 +518,10 @@ def is_draw(board):
     return False
 
 def qs(board, alpha, beta):
-    global to_flag
-    if to_flag.is_set():
+    global stats_node_count
+    if limits.stopped or (stats_node_count >= limits.next_check and limits.check(stats_node_count)):
         return -infinite
 
-    global stats_node_count
     stats_node_count += 1
 
     if board.is_checkmate():
@@ -262,24 +542,11 @@ def qs(board, alpha, beta):
             if best >= beta:
                 return best
 
-    moves = pc_to_list(board, [])
-
     move_count = 0
-    for m_work in moves:
-        m = m_work.move
-
-        if not board.is_legal(m):
+    for m in gen_moves(board, None, [], None, is_check):
+        if not board.is_legal_pseudo(m):
             continue
 
-        is_capture_move = board.piece_type_at(m.to_square) != None
-
-        if is_check == False:
-            if is_capture_move == False and m.promotion == None:
-                continue
-
-            if is_capture_move and blind(board, m):
-                continue
-
         move_count += 1
 
         board.push(m)
@@ -310,33 +577,74 @@ def tt_lookup_helper(board, alpha, beta, depth):
     if not tt_hit:
         return None
 
-    rc = (tt_hit.score, tt_hit.move)
+    score, flags, hit_depth, move = tt_hit
+
+    rc = (score, move)
 
-    if tt_hit.depth < depth:
+    if hit_depth < depth:
         return [ False, rc ]
 
-    if tt_hit.flags == 'E':
+    if flags == TT_EXACT:
         return [ True, rc ]
 
-    if tt_hit.flags == 'L' and tt_hit.score >= beta:
+    if flags == TT_LOWER and score >= beta:
         return [ True, rc ]
 
-    if tt_hit.flags == 'U' and tt_hit.score <= alpha:
+    if flags == TT_UPPER and score <= alpha:
         return [ True, rc ]
 
     return [ False, rc ]
 
-def search(board, alpha, beta, depth, siblings, max_depth, is_nm):
-    global to_flag
-    if to_flag.is_set():
+def pv_update(ply, m):
+    base = ply * max_ply
+    child_base = base + max_ply
+
+    pv_table[base + ply] = m
+
+    for i in range(ply + 1, pv_length[ply + 1]):
+        pv_table[base + i] = pv_table[child_base + i]
+
+    pv_length[ply] = max(pv_length[ply + 1], ply + 1)
+
+def pv_get():
+    return pv_table[0:pv_length[0]]
+
+def tb_score(wdl, ply):
+    """ cursed wins and blessed losses are draws by the 50 move rule """
+    if wdl > 1:
+        return tb_win - ply
+
+    if wdl < -1:
+        return -tb_win + ply
+
+    return 0
+
+def search(board, alpha, beta, depth, ply, max_depth, is_nm):
+    pv_length[ply] = ply
+
+    global stats_node_count
+    if limits.stopped or (stats_node_count >= limits.next_check and limits.check(stats_node_count)):
         return (-infinite, None)
 
+    if ply >= max_ply - 1:
+        return (evaluate(board), None)
+
     if board.is_checkmate():
         return (-checkmate, None)
 
     if is_draw(board):
         return (0, None)
 
+    # exact right after a capture or pawn move
+    if ply > 0 and board.halfmove_clock == 0:
+        wdl = tb_probe_wdl(board)
+
+        if wdl != None:
+            global stats_tb_hits
+            stats_tb_hits += 1
+
+            return (tb_score(wdl, ply), None)
+
     if depth == 0:
         if with_qs:
             return (qs(board, alpha, beta), None)
@@ -347,7 +655,6 @@ def search(board, alpha, beta, depth, siblings, max_depth, is_nm):
 
     top_of_tree = depth == max_depth
 
-    global stats_node_count
     stats_node_count += 1
 
     global stats_tt_checks
@@ -357,7 +664,9 @@ def search(board, alpha, beta, depth, siblings, max_depth, is_nm):
         global stats_tt_hits
         stats_tt_hits += 1
 
-        if tt_hit[0]:
+        # only cut-offs in zero window nodes: the root needs a move and
+        # pv nodes would lose their pv
+        if tt_hit[0] and ply > 0 and beta - alpha == 1:
             return tt_hit[1]
 
     alpha_orig = alpha
@@ -368,38 +677,40 @@ def search(board, alpha, beta, depth, siblings, max_depth, is_nm):
     ### NULL MOVE ###
     if not board.is_check() and depth >= 3 and not top_of_tree and not is_nm:
         board.push(chess.Move.null())
-        nm_result = search(board, -beta, -beta + 1, depth - 3, [], max_depth, True)
+        nm_result = search(board, -beta, -beta + 1, depth - 3, ply + 1, max_depth, True)
         board.pop()
 
         if -nm_result[0] >= beta:
             return (-nm_result[0], None)
     #################
 
-    moves_first = []
+    tt_move = None
     if tt_hit and tt_hit[1][1]:
-        moves_first.append(tt_hit[1][1])
-
-    moves_first += siblings
-
-    moves = pc_to_list(board, moves_first)
-
-    new_siblings = []
+        tt_move = tt_hit[1][1]
 
     is_check = board.is_check()
     allow_lmr = depth >= 3 and not is_check
 
+    ply_killers = killers[ply] if ply < max_ply else []
+
+    tried_quiets = []
+
     move_count = 0
-    for m_work in moves:
-        m = m_work.move
-        if not board.is_legal(m):
+    for m in gen_moves(board, tt_move, ply_killers[:], get_countermove(board), True):
+        if ply == 0 and root_filter and not m in root_filter:
+            continue
+
+        if not board.is_legal_pseudo(m):
             continue
 
         move_count += 1
 
         new_depth = depth - 1
 
+        quiet = is_quiet(board, m)
+
         lmr = False
-        if allow_lmr and move_count >= 4 and not board.is_capture(m) and not m.promotion:
+        if allow_lmr and move_count >= 4 and quiet:
             lmr = True
             new_depth -= 1
 
@@ -408,41 +719,54 @@ def search(board, alpha, beta, depth, siblings, max_depth, is_nm):
 
         board.push(m)
 
-        result = search(board, -beta, -alpha, new_depth, new_siblings, max_depth, False)
-        score = -result[0]
+        if move_count == 1:
+            result = search(board, -beta, -alpha, new_depth, ply + 1, max_depth, False)
+            score = -result[0]
 
-        if score > alpha and lmr:
-            result = search(board, -beta, -alpha, depth - 1, new_siblings, max_depth, False)
+        else:
+            # principal variation search: prove with a zero window that
+            # this move is not better, re-search when that fails
+            result = search(board, -alpha - 1, -alpha, new_depth, ply + 1, max_depth, False)
             score = -result[0]
 
+            if score > alpha and lmr:
+                result = search(board, -alpha - 1, -alpha, depth - 1, ply + 1, max_depth, False)
+                score = -result[0]
+
+            if score > alpha and score < beta:
+                result = search(board, -beta, -alpha, depth - 1, ply + 1, max_depth, False)
+                score = -result[0]
+
         board.pop()
 
         if score > best:
             best = score
             best_move = m
 
-            if not m in siblings:
-                if len(siblings) == 2:
-                    del siblings[-1]
-
-                siblings.insert(0, m)
-
             if score > alpha:
                 alpha = score
 
+                pv_update(ply, m)
+
                 if score >= beta:
+                    if quiet:
+                        history_update(board, m, depth, tried_quiets, ply)
+
                     global stats_avg_bco_index, stats_avg_bco_index_cnt
                     stats_avg_bco_index += move_count - 1
                     stats_avg_bco_index_cnt += 1
                     break
 
+        if quiet:
+            tried_quiets.append(m)
+
     if move_count == 0:
         if not is_check:
             return (0, None)
 
-        l('ERR')
+        l('ERR', level=LOG_ERROR)
 
-    if alpha > alpha_orig and not to_flag.is_set():
+    if alpha > alpha_orig and not limits.stopped:
         bm = None
         if best >= alpha_orig:
             bm = best_move
@@ -451,20 +775,24 @@ def search(board, alpha, beta, depth, siblings, max_depth, is_nm):
 
     return (best, best_move)
 
-def calc_move(board, max_think_time, max_depth, is_ponder):
-    global to_flag
-    to_flag = threading.Event()
-    to_flag.clear()
+def calc_move(board, max_think_time, max_depth, is_ponder=False, verbose=True, soft_time=None, max_nodes=None, mate=None, search_limits=None, iteration_cb=None):
+    """ max_think_time is the hard limit, soft_time the time the time
+        manager aims for; without soft_time the search uses all of
+        max_think_time. With mate set, the search stops when a mate in
+        that many moves is found. A ponder search has no limits until
+        cm_ponderhit(). iteration_cb(result, nodes) is invoked for every
+        depth that completed within the aspiration window.
+        Returns [score, move, depth, time, ponder move]. """
+    global limits
+    limits = search_limits or SearchLimits(max_think_time, max_nodes)
 
-    t = None
-    if max_think_time:
-        t = threading.Timer(max_think_time, set_to_flag, args=[to_flag])
-        t.start()
+    if mate:
+        max_depth = min(max_depth, mate * 2 - 1)
 
     reset_stats()
     tt_inc_age()
 
-    l(board.fen())
+    l(board.fen(), level=LOG_DEBUG)
 
     # FIXME
     if board.move_count() == 1 and not is_ponder:
@@ -473,42 +801,87 @@ def calc_move(board, max_think_time, max_depth, is_ponder):
         for m in board.get_move_list():
             break
 
-        return [ 0, m, 0, 0.0 ]
+        return [ 0, m, 0, 0.0, None ]
+
+    # only search the moves that keep the tablebase result; when that is
+    # a win or a loss, dtz already tells what to play
+    global root_filter
+    root_filter = None
+
+    tb_root = tb_root_moves(board)
+    if tb_root:
+        wdl, root_filter = tb_root
+
+        if wdl != 0 and not is_ponder:
+            score = tb_score(wdl, 0)
+            msg = 'depth 1 score cp %d time 0 nodes 0 pv %s' % (score, root_filter[0].uci())
+
+            if verbose:
+                print('info %s' % msg)
+                sys.stdout.flush()
+
+            l(msg)
+
+            return [ score, root_filter[0], 1, 0.0, None ]
 
     result = None
     alpha = -infinite
     beta = infinite
 
-    siblings = []
+    smp_search_start(board, max_depth)
+
+    # history of the previous move still says something, killers don't
+    history_age(2)
+
+    for k in killers:
+        k[0] = k[1] = None
+
+    tm_start_search(soft_time, max_think_time)
+
+    with ponder_lock:
+        limits.tm_started = True
+
+        # a ponderhit that came in before the time manager was started
+        if limits.ponderhit_times:
+            ponderhit_apply(*limits.ponderhit_times)
+
     start_ts = time.time()
     d = 1
     while d < max_depth + 1:
-        cur_result = search(board, alpha, beta, d, siblings, d, False)
+        cur_result = search(board, alpha, beta, d, 0, d, False)
 
         diff_ts = time.time() - start_ts
 
-        if to_flag.is_set():
+        if limits.stopped:
             if result:
                 result[3] = diff_ts
             break
 
         stats = get_stats()
 
-        if cur_result[1]:
+        # building the pv line is not free
+        if cur_result[1] and (verbose or l_enabled(LOG_DEBUG)):
             diff_ts_ms = math.ceil(diff_ts * 1000.0)
 
-            pv = tt_get_pv(board, cur_result[1])
-            msg = 'depth %d score cp %d time %d nodes %d pv %s' % (d, cur_result[0], diff_ts_ms, stats['stats_node_count'], pv)
+            pv = ' '.join([ m.uci() for m in pv_get() ])
+            if pv_length[0] == 0:
+                pv = cur_result[1].uci()
+            msg = 'depth %d score cp %d time %d nodes %d hashfull %d pv %s' % (d, cur_result[0], diff_ts_ms, stats['stats_node_count'], tt_hashfull(), pv)
 
-            if not is_ponder:
+            if verbose:
                 print('info %s' % msg)
                 sys.stdout.flush()
 
-            l(msg)
+            l(msg, level=LOG_DEBUG)
+
+        # the expected reply, for 'bestmove ... ponder ...'
+        ponder_move = None
+        if pv_length[0] >= 2 and pv_table[0] == cur_result[1]:
+            ponder_move = pv_table[1]
 
-        result = [cur_result[0], cur_result[1], d, diff_ts]
+        result = [cur_result[0], cur_result[1], d, diff_ts, ponder_move]
 
-        if max_think_time and diff_ts > max_think_time / 2.0:
+        if mate and cur_result[0] >= checkmate:
             break
 
         if cur_result[0] <= alpha:
@@ -524,20 +897,47 @@ def calc_move(board, max_think_time, max_depth, is_ponder):
             if beta > infinite:
                 beta = infinite
 
+            # once per depth, not for fail-low/high re-searches
+            if iteration_cb:
+                iteration_cb(result, stats_node_count)
+
             d += 1
 
-        #l('a: %d, b: %d' % (alpha, beta))
+            history_age(1)
+
+            if not tm_iteration_done(cur_result[1]):
+                break
+
+        #l('a: %d, b: %d', alpha, beta)
+
+    helper_nodes = 0
+    for nr, h_depth, h_score, h_move, h_nodes in smp_search_stop():
+        helper_nodes += h_nodes
+
+        if h_move and root_filter and not chess.Move.from_uci(h_move) in root_filter:
+            continue
+
+        if h_move and (result == None or h_depth > result[2]):
+            l('using result of helper %d: depth %d score %d move %s', nr, h_depth, h_score, h_move)
+
+            result = [h_score, chess.Move.from_uci(h_move), h_depth, time.time() - start_ts, None]
+
+    if helper_nodes and result and result[1]:
+        msg = 'depth %d score cp %d time %d nodes %d pv %s' % (result[2], result[0], math.ceil(result[3] * 1000.0), stats_node_count + helper_nodes, result[1].uci())
 
-    if t:
-        t.cancel()
+        if verbose:
+            print('info %s' % msg)
+            sys.stdout.flush()
+
+        l(msg)
 
     if result == None or result[1] == None:
         l('random move!')
         l(board.get_stats())
 
-        result = [ 0, random_move(board), 0, time.time() - start_ts ]
+        result = [ 0, random_move(board), 0, time.time() - start_ts, None ]
 
-    l('selected move: %s' % result)
+    l('selected move: %s', result, level=LOG_DEBUG)
 
     diff_ts = time.time() - start_ts
 
@@ -548,19 +948,45 @@ def calc_move(board, max_think_time, max_depth, is_ponder):
         avg_bco = float(stats['stats_avg_bco_index']) / stats['stats_avg_bco_index_cnt']
 
     if stats['stats_tt_checks'] and diff_ts > 0:
-        l('nps: %f, nodes: %d, tt_hits: %f%%, avg bco index: %.2f' % (stats['stats_node_count'] / diff_ts, stats['stats_node_count'], stats['stats_tt_hits'] * 100.0 / stats['stats_tt_checks'], avg_bco))
+        l('nps: %f, nodes: %d, tt_hits: %f%%, avg bco index: %.2f, pawn hash hits: %f%%, eval cache hits: %f%%, tb hits: %d', stats['stats_node_count'] / diff_ts, stats['stats_node_count'], stats['stats_tt_hits'] * 100.0 / stats['stats_tt_checks'], avg_bco, stats['stats_ph_hits'] * 100.0 / max(1, stats['stats_ph_checks']), stats['stats_ec_hits'] * 100.0 / max(1, stats['stats_ec_hits'] + stats['stats_ec_misses']), stats['stats_tb_hits'])
 
     return result
 
-def calc_move_wrapper(board, duration, depth, is_ponder):
+def helper_search(board, max_depth, start_depth, stop):
+    """ lazy smp helper (see smp.py): plain iterative deepening, returns
+        (depth, score, move, nodes) of the last completed iteration """
+    global limits
+    limits = SearchLimits(stop_event=stop)
+
+    reset_stats()
+
+    result = (0, 0, None)
+
+    d = start_depth
+    while d < max_depth + 1:
+        cur_result = search(board, -infinite, infinite, d, 0, d, False)
+
+        if limits.stopped:
+            break
+
+        if cur_result[1]:
+            result = (d, cur_result[0], cur_result[1].uci())
+
+        d += 1
+
+        history_age(1)
+
+    return result + (stats_node_count,)
+
+def calc_move_wrapper(board, duration, depth, is_ponder, soft_duration, mate, search_limits):
     global thread_result
 
     try:
-        thread_result = calc_move(board, duration, depth, is_ponder)
+        thread_result = calc_move(board, duration, depth, is_ponder, soft_time=soft_duration, mate=mate, search_limits=search_limits)
 
     except Exception as ex:
-        l(str(ex))
-        l(traceback.format_exc())
+        l(str(ex), level=LOG_ERROR)
+        l(traceback.format_exc(), level=LOG_ERROR)
 
         thread_result = None
 
@@ -572,9 +998,9 @@ def random_move(board):
     while True:
         idx = random.randint(0, len(moves) - 1)
 
-        l('n moves: %d, chosen: %d = %s' % (len(moves), idx, moves[idx]))
+        l('n moves: %d, chosen: %d = %s', len(moves), idx, moves[idx], level=LOG_DEBUG)
 
-        if board.is_legal(moves[idx]):
+        if board.is_legal_pseudo(moves[idx]):
             break
 
     return moves[idx]
@@ -582,9 +1008,17 @@ def random_move(board):
 thread = None
 thread_result = None
 
-def cm_thread_start(board, duration=None, depth=999999, is_ponder=False):
-    global thread
-    thread = threading.Thread(target=calc_move_wrapper, args=(board,duration,depth,is_ponder,))
+# serializes cm_ponderhit() and the start of the time manager
+ponder_lock = threading.Lock()
+
+def cm_thread_start(board, duration=None, depth=999999, is_ponder=False, soft_duration=None, max_nodes=None, mate=None):
+    global thread, limits
+
+    # created here so that a cm_thread_stop() right after this can't
+    # miss the search
+    limits = SearchLimits(duration, max_nodes)
+
+    thread = threading.Thread(target=calc_move_wrapper, args=(board,duration,depth,is_ponder,soft_duration,mate,limits,))
     thread.start()
 
 def cm_thread_check():
@@ -596,10 +1030,24 @@ def cm_thread_check():
 
     return False
 
+def cm_ponderhit(soft_duration, duration):
+    """ the opponent played the move we pondered on: the running search
+        continues, now on the clock """
+    with ponder_lock:
+        limits.ponderhit(soft_duration, duration)
+
+        # else calc_move() applies it after starting the time manager,
+        # which would overwrite it
+        if limits.tm_started:
+            ponderhit_apply(soft_duration, duration)
+
+def ponderhit_apply(soft_duration, duration):
+    if not tm_ponderhit(soft_duration, duration):
+        l('ponderhit: enough depth already')
+        limits.stop()
+
 def cm_thread_stop():
-    global to_flag
-    if to_flag:
-        set_to_flag(to_flag)
+    limits.stop()
 
     global thread
     if not thread:
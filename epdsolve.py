@@ -0,0 +1,123 @@
+import json
+import math
+import multiprocessing
+import os
+import time
+from board import Board
+from smp import worker_init, worker_hash_mb
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Test suite solver: every EPD position with a 'bm' (best move) or 'am'
+# (avoid move) operation is searched with a time and/or node budget, the
+# positions are divided over a pool of processes. A position counts as
+# solved when the move played is a bm (and not an am); the time and
+# nodes to solution are those of the first iteration from which on the
+# search kept playing a correct move.
+
+epd_default_time = 1000 # ms
+
+def epd_is_correct(move, bm, am):
+    if bm and not move in bm:
+        return False
+
+    return not move in am
+
+def epd_solve_position(args):
+    """ runs in a pool process """
+    from brain import calc_move, history_clear
+    from tt import tt_clear
+
+    nr, line, max_time, max_nodes, max_depth = args
+
+    board = Board()
+    ops = board.set_epd(line)
+
+    bm = ops.get('bm', [])
+    am = ops.get('am', [])
+
+    tt_clear()
+    history_clear()
+
+    # [ time, nodes ] of the first iteration of the current streak of
+    # correct moves
+    first_ok = [ None ]
+
+    def iteration(result, nodes):
+        if epd_is_correct(result[1], bm, am):
+            if first_ok[0] == None:
+                first_ok[0] = (result[3], nodes)
+
+        else:
+            first_ok[0] = None
+
+    start = time.time()
+    result = calc_move(board, max_time, max_depth, verbose=False, max_nodes=max_nodes, iteration_cb=iteration)
+    took = time.time() - start
+
+    solved = epd_is_correct(result[1], bm, am)
+
+    entry = { 'nr' : nr, 'id' : ops.get('id', ''), 'fen' : board.fen(), 'bm' : [ board.san(m) for m in bm ], 'am' : [ board.san(m) for m in am ], 'move' : board.san(result[1]) if result[1] else None, 'depth' : result[2], 'solved' : solved, 'time_ms' : int(math.ceil(took * 1000.0)) }
+
+    if solved:
+        # no iterations: a forced (or tablebase) move
+        t, n = first_ok[0] or (took, 0)
+
+        entry['solution_time_ms'] = int(math.ceil(t * 1000.0))
+        entry['solution_nodes'] = n
+
+    return entry
+
+def run_epd_solve(file_, max_time=epd_default_time, max_nodes=None, max_depth=999, processes=None, as_json=False):
+    """ max_time in ms; returns the summary dict """
+    if processes == None:
+        processes = os.cpu_count() or 1
+
+    jobs = []
+
+    with open(file_, 'r') as fh:
+        for line in fh:
+            line = line.strip()
+
+            if len(line) == 0 or line[0] == '#':
+                continue
+
+            if not ' bm ' in line and not ' am ' in line:
+                continue
+
+            jobs.append((len(jobs) + 1, line, max_time / 1000.0 if max_time else None, max_nodes, max_depth))
+
+    start = time.time()
+
+    ctx = multiprocessing.get_context('spawn')
+    positions = []
+
+    with ctx.Pool(max(1, min(processes, len(jobs))), worker_init, (worker_hash_mb,)) as pool:
+        for entry in pool.imap(epd_solve_position, jobs):
+            positions.append(entry)
+
+            if not as_json:
+                if entry['solved']:
+                    print('%4d/%d %-20s ok     %-7s time %6d ms nodes %8d' % (entry['nr'], len(jobs), entry['id'][:20], entry['move'], entry['solution_time_ms'], entry['solution_nodes']))
+
+                else:
+                    print('%4d/%d %-20s FAILED %-7s (bm %s am %s)' % (entry['nr'], len(jobs), entry['id'][:20], entry['move'], ' '.join(entry['bm']), ' '.join(entry['am'])))
+
+    took = time.time() - start
+
+    solved = [ p for p in positions if p['solved'] ]
+
+    summary = { 'file' : file_, 'positions' : len(positions), 'solved' : len(solved), 'time_ms' : int(math.ceil(took * 1000.0)), 'solution_time_ms' : sum(p['solution_time_ms'] for p in solved), 'solution_nodes' : sum(p['solution_nodes'] for p in solved), 'results' : positions }
+
+    if as_json:
+        print(json.dumps(summary))
+
+    else:
+        print('===========================')
+        print('Solved          : %d/%d' % (summary['solved'], summary['positions']))
+        print('Total time (ms) : %d' % summary['time_ms'])
+        print('Time to solve   : %d ms' % summary['solution_time_ms'])
+        print('Nodes to solve  : %d' % summary['solution_nodes'])
+
+    return summary
@@ -1,18 +1,142 @@
+import atexit
+import os
+import queue
+import threading
 import time
 
 # (C) 2017 by folkert@vanheusden.com
 # released under AGPL v3.0
 
+# Messages are put on a queue and written by a background thread, so the
+# engine thread never waits for the filesystem. Formatting ('msg % args')
+# is also done by that thread and only for messages that pass the level
+# check; a disabled level costs one comparison.
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LOG_NONE = 100
+
+log_level_names = { 'debug' : LOG_DEBUG, 'info' : LOG_INFO, 'warning' : LOG_WARNING, 'error' : LOG_ERROR, 'none' : LOG_NONE }
+
 logfile = 'feeks.dat'
+log_level = LOG_INFO
+log_max_size = 16 * 1024 * 1024
+log_backups = 3
 
-def l(msg):
-	global logfile
+log_q = queue.SimpleQueue()
+log_thread = None
+log_lock = threading.Lock()
+
+def l(msg, *args, level=LOG_INFO):
+	if level < log_level:
+		return
+
+	if not log_thread:
+		start_l()
+
+	log_q.put((time.time(), msg, args))
+
+def l_enabled(level):
+	return level >= log_level
+
+def start_l():
+	global log_thread
 
-	fh = open(logfile, 'a')
-	fh.write('%s %s\n' % (time.asctime(), msg))
+	with log_lock:
+		if log_thread:
+			return
+
+		log_thread = threading.Thread(target=log_writer)
+		log_thread.daemon = True
+		log_thread.start()
+
+def rotate_l(fh):
 	fh.close()
 
+	for i in range(log_backups - 1, 0, -1):
+		if os.path.exists('%s.%d' % (logfile, i)):
+			os.replace('%s.%d' % (logfile, i), '%s.%d' % (logfile, i + 1))
+
+	os.replace(logfile, '%s.1' % logfile)
+
+	return open(logfile, 'a')
+
+def log_writer():
+	fh = None
+	cur_file = None
+
+	while True:
+		item = log_q.get()
+		if item == None:
+			break
+
+		if isinstance(item, threading.Event):
+			if fh:
+				fh.flush()
+
+			item.set()
+			continue
+
+		ts, msg, args = item
+
+		try:
+			if cur_file != logfile:
+				if fh:
+					fh.close()
+
+				cur_file = logfile
+				fh = open(logfile, 'a')
+
+			fh.write('%s %s\n' % (time.asctime(time.localtime(ts)), msg % args if args else msg))
+
+			if log_max_size and fh.tell() >= log_max_size:
+				fh = rotate_l(fh)
+
+			if log_q.empty():
+				fh.flush()
+
+		except Exception as e:
+			# nowhere to report this
+			pass
+
+	if fh:
+		fh.close()
+
+def flush_l():
+	""" blocks until everything queued so far is written """
+	if not log_thread:
+		return
+
+	done = threading.Event()
+	log_q.put(done)
+	done.wait(5.0)
+
+def stop_l():
+	global log_thread
+
+	if not log_thread:
+		return
+
+	log_q.put(None)
+	log_thread.join(5.0)
+	log_thread = None
+
+atexit.register(stop_l)
+
 def set_l(file_):
 	global logfile
 
 	logfile = file_
+
+def set_l_level(level):
+	global log_level
+
+	if isinstance(level, str):
+		if not level.lower() in log_level_names:
+			raise ValueError('unknown log level: %s' % level)
+
+		level = log_level_names[level.lower()]
+
+	log_level = level
@@ -6,19 +6,25 @@
 from board import Board
 import chess
 import chess.polyglot
-import math
 from multiprocessing import Queue
-from select import select
 import sys
 import threading
 from threading import Thread
-import time
 import traceback
-from tt import tt_init, tt_lookup
-from brain import calc_move, cm_thread_start, cm_thread_check, cm_thread_stop, random_move, evaluate, pc_to_list
-from log import set_l, l
-
-tt_n_elements = 1024 * 8
+from tt import tt_init, tt_lookup, tt_release, tt_set_file, tt_save, tt_load
+from smp import smp_init, smp_shutdown, smp_set_option
+from brain import calc_move, cm_thread_start, cm_ponderhit, cm_thread_check, cm_thread_stop, random_move, evaluate, pc_to_list, ec_init, ec_default_mb
+from log import set_l, set_l_level, l, flush_l, LOG_DEBUG, LOG_ERROR
+from bench import run_bench, bench_default_depth
+from timeman import tm_allocate, tm_movetime, tm_set_overhead, move_overhead
+from tb import tb_init, tb_set_probe_limit, tb_probe_limit
+from book import book_open, book_probe
+from epdsolve import run_epd_solve, epd_default_time
+from annotate import run_annotate, an_default_time
+from perft import perft, run_perft, perft_hash_init, perft_hash_size
+
+tt_hash_mb = 64
+smp_threads = 1
 ponder = True
 benchmark = False
 epd = False
@@ -29,14 +35,14 @@ class stdin_reader(threading.Thread):
         self.q = Queue()
 
     def run(self):
-        l('stdin thread started')
+        l('stdin thread started', level=LOG_DEBUG)
 
         while True:
             line = sys.stdin.readline()
 
             self.q.put(line)
 
-        l('stdin thread terminating')
+        l('stdin thread terminating', level=LOG_DEBUG)
 
     def get(self, to = None):
         try:
@@ -49,22 +55,9 @@ class stdin_reader(threading.Thread):
         except:
             return None
 
-def perft(board, depth):
-    if depth == 1:
-        return board.move_count()
-
-    total = 0
-
-    for m in board.get_move_list():
-        board.push(m)
-        total += perft(board, depth - 1)
-        board.pop()
-
-    return total
-
 def send(str_):
     print(str_)
-    l('OUT: %s' % str_)
+    l('OUT: %s', str_, level=LOG_DEBUG)
     sys.stdout.flush()
 
 def wait_init_thread(t):
@@ -80,6 +73,8 @@ def wait_init_thread(t):
     return None
 
 def main():
+    global tt_hash_mb, smp_threads, ponder
+
     t = threading.Thread(target=init_thread)
     t.start()
 
@@ -92,7 +87,6 @@ def main():
 
         while True:
             line = sr.get()
-            print(line)
             if line == None:
                 break
 
@@ -101,18 +95,107 @@ def main():
             if len(line) == 0:
                 continue
 
-            l('IN: %s' % line)
+            l('IN: %s', line, level=LOG_DEBUG)
 
             parts = line.split(' ')
             
             if parts[0] == 'uci':
                 send('id name Feeks')
                 send('id author Folkert van Heusden <mail@vanheusden.com>')
+                send('option name Hash type spin default %d min 1 max 4096' % tt_hash_mb)
+                send('option name Threads type spin default %d min 1 max 256' % smp_threads)
+                send('option name EvalCache type spin default %d min 1 max 1024' % ec_default_mb)
+                send('option name MoveOverhead type spin default %d min 0 max 5000' % move_overhead)
+                send('option name Ponder type check default %s' % ('true' if ponder else 'false'))
+                send('option name HashFile type string default <empty>')
+                send('option name BookFile type string default <empty>')
+                send('option name SyzygyPath type string default <empty>')
+                send('option name SyzygyProbeLimit type spin default %d min 0 max 7' % tb_probe_limit)
+                send('option name LogLevel type combo default info var debug var info var warning var error var none')
                 send('uciok')
 
             elif parts[0] == 'isready':
                 send('readyok')
 
+            elif parts[0] == 'setoption':
+                # setoption name <name> value <value>
+                if len(parts) >= 5 and parts[1] == 'name' and parts[3] == 'value':
+                    name = parts[2].lower()
+                    value = parts[4]
+
+                    try:
+                        if name == 'hash':
+                            t = wait_init_thread(t)
+                            cm_thread_stop()
+
+                            tt_hash_mb = max(1, int(value))
+                            smp_init(smp_threads, tt_hash_mb)
+
+                        elif name == 'threads':
+                            t = wait_init_thread(t)
+                            cm_thread_stop()
+
+                            smp_threads = max(1, int(value))
+                            smp_init(smp_threads, tt_hash_mb)
+
+                        elif name == 'ponder':
+                            ponder = value.lower() == 'true'
+
+                        elif name == 'hashfile':
+                            t = wait_init_thread(t)
+                            cm_thread_stop()
+
+                            tt_set_file(' '.join(parts[4:]))
+
+                            try:
+                                smp_init(smp_threads, tt_hash_mb)
+
+                            except OSError as e:
+                                # always have a table: back to plain memory
+                                l('HashFile %s failed: %s', ' '.join(parts[4:]), e, level=LOG_ERROR)
+                                send('info string HashFile failed: %s' % e)
+
+                                tt_set_file('')
+                                smp_init(smp_threads, tt_hash_mb)
+
+                        elif name == 'evalcache':
+                            cm_thread_stop()
+
+                            ec_mb = max(1, int(value))
+                            ec_init(ec_mb)
+                            smp_set_option('evalcache', ec_mb)
+
+                        elif name == 'syzygypath':
+                            cm_thread_stop()
+
+                            tb_path = ' '.join(parts[4:])
+                            tb_init(tb_path)
+                            smp_set_option('syzygypath', tb_path)
+
+                        elif name == 'syzygyprobelimit':
+                            tb_set_probe_limit(int(value))
+                            smp_set_option('syzygyprobelimit', int(value))
+
+                        elif name == 'bookfile':
+                            book_open(' '.join(parts[4:]))
+
+                        elif name == 'moveoverhead':
+                            tm_set_overhead(int(value))
+
+                        elif name == 'loglevel':
+                            set_l_level(value)
+                            smp_set_option('loglevel', value)
+
+                        else:
+                            l('unknown option: %s', parts[2])
+
+                    except ValueError as e:
+                        l('setoption %s failed: %s', parts[2], e, level=LOG_ERROR)
+                        send('info string invalid value for %s: %s' % (parts[2], e))
+
+                else:
+                    l('setoption syntax error: %s', line)
+
             elif parts[0] == 'ucinewgame':
                 board = Board()
                 cm_thread_stop()
@@ -144,30 +227,34 @@ def main():
 
                 print('done')
 
-            elif parts[0] == 'perft':
+            elif parts[0] == 'bench':
+                # bench [depth] [json]
+                t = wait_init_thread(t)
                 cm_thread_stop()
 
-                depth = 4
-                if len(parts) == 2:
-                        depth = int(parts[1])
+                depth = bench_default_depth
+                if len(parts) >= 2 and parts[1] != 'json':
+                    depth = int(parts[1])
 
-                start = time.time()
-                total = 0
+                run_bench(depth, 'json' in parts[1:])
 
-                for m in board.get_move_list():
-                    board.push(m)
-                    cnt = perft(board, depth - 1)
-                    board.pop()
+                sys.stdout.flush()
+
+            elif parts[0] == 'perft' or parts[0] == 'divide':
+                # perft|divide [depth] [processes]
+                cm_thread_stop()
+
+                depth = 4
+                if len(parts) >= 2:
+                    depth = int(parts[1])
 
-                    print('%s: %d' % (m.uci(), cnt))
+                processes = None
+                if len(parts) >= 3:
+                    processes = int(parts[2])
 
-                    total += cnt
+                run_perft(board, depth, parts[0] == 'divide', processes)
 
-                print('===========================')
-                took = time.time() - start
-                print('Total time (ms) : %d' % math.ceil(took * 1000.0))
-                print('Nodes searched  : %d' % total)
-                print('Nodes/second    : %d' % math.floor(total / took))
+                sys.stdout.flush()
 
             elif parts[0] == 'position':
                 is_moves = False
@@ -187,7 +274,7 @@ def main():
                         is_moves = True
 
                     else:
-                        l('unknown: %s' % parts[nr])
+                        l('unknown: %s', parts[nr])
 
                     nr += 1
 
@@ -201,6 +288,10 @@ def main():
                 wtime = btime = None
                 winc = binc = 0
                 movestogo = None
+                nodes = None
+                mate = None
+                infinite = False
+                pondering = False
 
                 nr = 1
                 while nr < len(parts):
@@ -232,77 +323,119 @@ def main():
                         depth = int(parts[nr + 1])
                         nr += 1
 
-                    else:
-                        l('unknown: %s' % parts[nr])
+                    elif parts[nr] == 'nodes':
+                        nodes = int(parts[nr + 1])
+                        nr += 1
 
-                    nr += 1
+                    elif parts[nr] == 'mate':
+                        mate = int(parts[nr + 1])
+                        nr += 1
 
-###
-                current_duration = movetime
+                    elif parts[nr] == 'infinite':
+                        infinite = True
 
-                if current_duration:
-                    current_duration = float(current_duration) / 1000.0
+                    elif parts[nr] == 'ponder':
+                        pondering = True
 
-                elif wtime and btime:
-                    ms = wtime
-                    time_inc = winc
-                    if not board.turn:
-                        ms = btime
-                        time_inc = binc
+                    else:
+                        l('unknown: %s', parts[nr])
 
-                    ms /= 1000.0
-                    time_inc /= 1000.0
+                    nr += 1
+
+                soft_duration = current_duration = None
 
-                    if movestogo == None:
-                        movestogo = 40 - board.fullmove_number
-                        while movestogo < 0:
-                            movestogo += 40
+                if infinite:
+                    pass
 
-                    current_duration = (ms + movestogo * time_inc) / (board.fullmove_number + 7);
+                elif movetime:
+                    soft_duration, current_duration = tm_movetime(movetime)
 
-                    limit_duration = ms / 15.0
-                    if current_duration > limit_duration:
-                        current_duration = limit_duration
+                elif wtime != None and btime != None:
+                    if board.turn:
+                        soft_duration, current_duration = tm_allocate(wtime, winc, movestogo, board.fullmove_number)
 
-                    if current_duration == 0:
-                        current_duration = 0.001
+                    else:
+                        soft_duration, current_duration = tm_allocate(btime, binc, movestogo, board.fullmove_number)
 
-                    l('mtg %d, ms %f, ti %f' % (movestogo, ms, time_inc))
-###
                 if current_duration:
-                    l('search for %f seconds' % current_duration)
+                    l('search for %s seconds (at most %f)', soft_duration, current_duration)
 
                 if depth == None:
                     depth = 999
 
-                cm_thread_start(board, current_duration, depth, False)
+                # no search when the book knows the position, not when
+                # analyzing or pondering
+                book_move = None if infinite or pondering else book_probe(board)
 
                 line = None
-                while cm_thread_check():
-                    line = sr.get(0.01)
 
-                    if line:
-                        line = line.rstrip('\n')
+                if book_move:
+                    result = [ 0, book_move, 0, 0.0, None ]
+
+                else:
+                    # 'go ponder' searches without limits until 'ponderhit'
+                    # puts it on the clock (with the times of this 'go')
+                    if pondering:
+                        cm_thread_start(board, None, depth, True, None, nodes, mate)
 
-                        if line == 'stop' or line == 'quit':
+                    else:
+                        cm_thread_start(board, current_duration, depth, False, soft_duration, nodes, mate)
+
+                    while cm_thread_check():
+                        line = sr.get(0.01)
+
+                        if line:
+                            line = line.rstrip('\n')
+
+                            if line == 'ponderhit' and pondering:
+                                pondering = False
+                                cm_ponderhit(soft_duration, current_duration)
+
+                            elif line == 'isready':
+                                send('readyok')
+
+                            elif line == 'stop' or line == 'quit':
+                                break
+
+                    # 'go infinite' and 'go ponder' only send bestmove
+                    # after 'stop' (or 'ponderhit'), also when the search
+                    # ended by itself
+                    while (infinite or pondering) and line != 'stop' and line != 'quit':
+                        line = sr.get()
+                        if line == None:
                             break
 
-                result = cm_thread_stop()
+                        line = line.rstrip('\n')
+
+                        if line == 'ponderhit':
+                            pondering = False
+
+                        elif line == 'isready':
+                            send('readyok')
+
+                    result = cm_thread_stop()
 
                 if line == 'quit':
                     break
 
                 if result and result[1]:
-                    send('bestmove %s' % result[1].uci())
                     board.push(result[1])
 
+                    # from the pv or else from the transposition table
+                    ponder_move = result[4]
+                    if not ponder_move:
+                        tt_hit = tt_lookup(board)
+                        ponder_move = tt_hit[3] if tt_hit else None
+
+                    if ponder and ponder_move and board.is_legal(ponder_move):
+                        send('bestmove %s ponder %s' % (result[1].uci(), ponder_move.uci()))
+
+                    else:
+                        send('bestmove %s' % result[1].uci())
+
                 else:
                     send('bestmove a1a1')
 
-                if ponder and not board.is_game_over():
-                    send('info string start pondering')
-                    cm_thread_start(board.copy(), is_ponder=True)
-
             elif parts[0] == 'quit':
                 break
 
@@ -352,28 +485,49 @@ def main():
                 send('%s' % calc_move(board, None, int(parts[2])))
                 board.pop()
 
+            elif parts[0] == 'savett' or parts[0] == 'loadtt':
+                # savett|loadtt <file>
+                t = wait_init_thread(t)
+                cm_thread_stop()
+
+                try:
+                    if parts[0] == 'savett':
+                        tt_save(' '.join(parts[1:]))
+
+                    elif not tt_load(' '.join(parts[1:])):
+                        send('info string %s does not contain a table of this size' % ' '.join(parts[1:]))
+
+                except Exception as e:
+                    l('%s failed: %s', parts[0], e, level=LOG_ERROR)
+                    send('info string %s failed: %s' % (parts[0], e))
+
             elif parts[0] == 'probett':
                 t = wait_init_thread(t)
                 print(tt_lookup(board))
 
             else:
-                l('unknown: %s' % parts[0])
+                l('unknown: %s', parts[0])
                 send('Unknown command')
 
                 sys.stdout.flush()
 
-        cm_thread_stop()
-
     except KeyboardInterrupt as ki:
         l('ctrl+c pressed')
-        cm_thread_stop()
 
     except Exception as ex:
-        l(str(ex))
-        l(traceback.format_exc())
+        l(str(ex), level=LOG_ERROR)
+        l(traceback.format_exc(), level=LOG_ERROR)
+
+    finally:
+        cm_thread_stop()
+        smp_shutdown()
+        tt_release()
+
+        # everything logged so far is on disk before the process exits
+        flush_l()
 
 def init_thread():
-    tt_init(tt_n_elements)
+    tt_init(tt_hash_mb)
 
 def benchmark_test():
     board = Board()
@@ -381,7 +535,7 @@ def benchmark_test():
 
 def epd_test(str_):
     parts = str_.split(';')
-    board = chess.Board(parts[0])
+    board = Board(parts[0])
 
     print(parts[0])
 
@@ -406,23 +560,82 @@ def epd_test(str_):
             print('FAIL!')
             sys.exit(1)
 
-if len(sys.argv) == 2:
-    set_l(sys.argv[1])
-
-if benchmark:
-    init_thread() # run sync
-    import cProfile
-    cProfile.run('benchmark_test()', 'restats')
-elif epd:
-    init_thread() # run sync
-    while True:
-        line = sys.stdin.readline()
-        if not line:
-            break
-
-        if len(line) == 0 or line[0] == '#':
-            continue
+if __name__ == '__main__':
+    if len(sys.argv) >= 2 and sys.argv[1] == 'bench':
+        # main.py bench [depth] [json]
+        init_thread() # run sync
+
+        depth = bench_default_depth
+        if len(sys.argv) >= 3 and sys.argv[2] != 'json':
+            depth = int(sys.argv[2])
+
+        run_bench(depth, 'json' in sys.argv[2:])
+
+        sys.exit(0)
+
+    if len(sys.argv) >= 3 and sys.argv[1] == 'solve':
+        # main.py solve <file> [time <ms>] [nodes <n>] [depth <n>] [processes <n>] [json]
+        args = { 'time' : epd_default_time, 'nodes' : None, 'depth' : 999, 'processes' : None }
+
+        nr = 3
+        while nr < len(sys.argv):
+            if sys.argv[nr] in args and nr + 1 < len(sys.argv):
+                args[sys.argv[nr]] = int(sys.argv[nr + 1])
+                nr += 1
+
+            elif sys.argv[nr] != 'json':
+                print('unknown: %s' % sys.argv[nr])
+                sys.exit(1)
+
+            nr += 1
+
+        # with only a node budget, don't stop on time
+        if args['nodes'] and not 'time' in sys.argv[3:]:
+            args['time'] = None
+
+        run_epd_solve(sys.argv[2], args['time'], args['nodes'], args['depth'], args['processes'], 'json' in sys.argv[3:])
+
+        sys.exit(0)
+
+    if len(sys.argv) >= 3 and sys.argv[1] == 'annotate':
+        # main.py annotate <file.pgn> [out <file>] [time <ms>] [nodes <n>] [depth <n>] [processes <n>]
+        args = { 'out' : None, 'time' : an_default_time, 'nodes' : None, 'depth' : 999, 'processes' : None }
+
+        nr = 3
+        while nr + 1 < len(sys.argv) and sys.argv[nr] in args:
+            args[sys.argv[nr]] = sys.argv[nr + 1] if sys.argv[nr] == 'out' else int(sys.argv[nr + 1])
+            nr += 2
+
+        if nr < len(sys.argv):
+            print('unknown: %s' % sys.argv[nr])
+            sys.exit(1)
+
+        # with only a node budget, don't stop on time
+        if args['nodes'] and not 'time' in sys.argv[3:]:
+            args['time'] = None
+
+        run_annotate(sys.argv[2], args['out'], args['time'], args['nodes'], args['depth'], args['processes'])
+
+        sys.exit(0)
+
+    if len(sys.argv) == 2:
+        set_l(sys.argv[1])
+
+    if benchmark:
+        init_thread() # run sync
+        import cProfile
+        cProfile.run('benchmark_test()', 'restats')
+    elif epd:
+        init_thread() # run sync
+        perft_hash_init(perft_hash_size)
+        while True:
+            line = sys.stdin.readline()
+            if not line:
+                break
+
+            if len(line) == 0 or line[0] == '#':
+                continue
 
-        epd_test(line)
-else:
-    main()
+            epd_test(line)
+    else:
+        main()
@@ -0,0 +1,384 @@
+#! /usr/bin/python
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Self-play match runner: two UCI engine configurations (e.g. this tree
+# and a checkout of an other revision, or the same engine with different
+# options) play games in parallel worker processes. Every opening is
+# played twice with colors reversed. Games are written as PGN with a
+# 'score/depth time' comment per move; after every game the Elo
+# difference is estimated and an SPRT decides when to stop. A game is
+# adjudicated a draw after maxmoves moves (by each side) of the engines.
+#
+# usage: match.py engine1 <cmd> engine2 <cmd> [option1 <name>=<value>]
+#         [option2 <name>=<value>] [openings <file.epd|file.pgn>]
+#         [games <n>] [concurrency <n>] [tc <seconds>+<inc>]
+#         [movetime <ms>] [nodes <n>] [pgn <file>] [sprt <elo0> <elo1>]
+#         [alpha <a>] [beta <b>] [maxmoves <n>]
+
+import chess
+import chess.engine
+import chess.pgn
+import math
+import multiprocessing
+import os
+import queue
+import shlex
+import subprocess
+import sys
+import time
+
+match_max_moves = 200 # full moves
+
+def load_openings(file_):
+    """ list of (fen, [ moves ]) """
+    openings = []
+
+    if file_.endswith('.pgn'):
+        with open(file_, 'r') as fh:
+            while True:
+                game = chess.pgn.read_game(fh)
+                if game == None:
+                    break
+
+                openings.append((game.board().fen(), [ m.uci() for m in game.mainline_moves() ]))
+
+    else:
+        with open(file_, 'r') as fh:
+            for line in fh:
+                line = line.strip()
+
+                if len(line) == 0 or line[0] == '#':
+                    continue
+
+                board, ops = chess.Board.from_epd(line)
+                openings.append((board.fen(), []))
+
+    return openings
+
+def format_score(score):
+    """ pawns (or mate distance) from the point of view of the mover """
+    if score == None:
+        return '?'
+
+    if score.is_mate():
+        return '%sM%d' % ('+' if score.mate() > 0 else '-', abs(score.mate()))
+
+    return '%+.2f' % (score.score() / 100.0)
+
+def play_game(args):
+    """ runs in a worker process, returns (nr, white, result, pgn) """
+    nr, opening, engines, white, limits, max_moves = args
+
+    fen, opening_moves = opening
+
+    game = chess.pgn.Game()
+    game.headers['Event'] = 'Feeks match'
+    game.headers['Round'] = str(nr)
+    game.headers['White'] = engines[white][2]
+    game.headers['Black'] = engines[1 - white][2]
+
+    board = chess.Board(fen)
+    if fen != chess.STARTING_FEN:
+        game.setup(board)
+
+    node = game
+    for uci in opening_moves:
+        m = chess.Move.from_uci(uci)
+        board.push(m)
+        node = node.add_variation(m)
+
+    players = {}
+    result = None
+    termination = None
+
+    try:
+        for color, idx in ((chess.WHITE, white), (chess.BLACK, 1 - white)):
+            cmd, options, name = engines[idx]
+
+            players[color] = chess.engine.SimpleEngine.popen_uci(cmd, stderr=subprocess.DEVNULL)
+            players[color].configure(options)
+
+        clock = { chess.WHITE : limits.get('tc', (0, 0))[0], chess.BLACK : limits.get('tc', (0, 0))[0] }
+        inc = limits.get('tc', (0, 0))[1]
+
+        n_moves = 0
+
+        while not board.is_game_over(claim_draw=True):
+            # n_moves counts plies
+            if n_moves >= max_moves * 2:
+                result = '1/2-1/2'
+                termination = 'adjudication'
+                break
+
+            if 'tc' in limits:
+                limit = chess.engine.Limit(white_clock=clock[chess.WHITE], black_clock=clock[chess.BLACK], white_inc=inc, black_inc=inc)
+
+            else:
+                limit = chess.engine.Limit(time=limits.get('movetime'), nodes=limits.get('nodes'))
+
+            start = time.monotonic()
+            played = players[board.turn].play(board, limit, info=chess.engine.INFO_SCORE, game=nr)
+            took = time.monotonic() - start
+
+            if 'tc' in limits:
+                clock[board.turn] -= took
+
+                if clock[board.turn] < 0:
+                    result = '0-1' if board.turn == chess.WHITE else '1-0'
+                    termination = 'time forfeit'
+                    break
+
+                clock[board.turn] += inc
+
+            if played.move == None or not board.is_legal(played.move):
+                result = '0-1' if board.turn == chess.WHITE else '1-0'
+                termination = 'illegal move'
+                break
+
+            score = played.info.get('score')
+            comment = '%s/%d %.3fs' % (format_score(score.relative if score else None), played.info.get('depth', 0), took)
+
+            node = node.add_variation(played.move, comment=comment)
+            board.push(played.move)
+
+            n_moves += 1
+
+        if result == None:
+            result = board.result(claim_draw=True)
+
+    except chess.engine.EngineError as e:
+        # the engine that crashed loses
+        result = '0-1' if board.turn == chess.WHITE else '1-0'
+        termination = 'engine error: %s' % e
+
+    finally:
+        for p in players.values():
+            try:
+                p.quit()
+
+            except Exception as e:
+                p.close()
+
+    game.headers['Result'] = result
+    if termination:
+        game.headers['Termination'] = termination
+
+    return (nr, white, result, str(game))
+
+def elo(w, d, l):
+    """ (elo difference, 95% error margin) of the first engine """
+    n = w + d + l
+    if n == 0:
+        return (0.0, 0.0)
+
+    score = (w + d / 2.0) / n
+    if score <= 0.0 or score >= 1.0:
+        return (math.copysign(float('inf'), score - 0.5), 0.0)
+
+    diff = -400.0 * math.log10(1.0 / score - 1.0)
+
+    # standard deviation of the score of one game, normal approximation
+    dev = math.sqrt((w * (1.0 - score) ** 2 + d * (0.5 - score) ** 2 + l * score ** 2) / n)
+    lo = score - 1.96 * dev / math.sqrt(n)
+    hi = score + 1.96 * dev / math.sqrt(n)
+
+    if lo <= 0.0 or hi >= 1.0:
+        return (diff, float('inf'))
+
+    margin = (-400.0 * math.log10(1.0 / hi - 1.0) + 400.0 * math.log10(1.0 / lo - 1.0)) / 2.0
+
+    return (diff, margin)
+
+def sprt_llr(w, d, l, elo0, elo1):
+    """ log likelihood ratio of H1 (elo1) against H0 (elo0), trinomial
+        model with the normal approximation """
+    if w + d + l == 0:
+        return 0.0
+
+    # half a game of each outcome so that a one-sided result (no losses
+    # or no wins at all) still has a variance
+    w += 0.5
+    d += 0.5
+    l += 0.5
+    n = w + d + l
+
+    score = (w + d / 2.0) / n
+    var = (w + d / 4.0) / n - score ** 2
+    if var <= 0.0:
+        return 0.0
+
+    s0 = 1.0 / (1.0 + 10.0 ** (-elo0 / 400.0))
+    s1 = 1.0 / (1.0 + 10.0 ** (-elo1 / 400.0))
+
+    return (s1 - s0) * (2.0 * score - s0 - s1) / (2.0 * var / n)
+
+def parse_engine(cmd, options, name):
+    opts = {}
+
+    for o in options:
+        key, value = o.split('=', 1)
+        opts[key] = value
+
+    return (shlex.split(cmd), opts, name)
+
+def run_match(engines, openings, n_games, concurrency, limits, pgn_file=None, sprt=None, max_moves=match_max_moves):
+    """ engines: two (cmd, options, name); sprt: (elo0, elo1, alpha,
+        beta) or None. Returns (wins, draws, losses) of the first. """
+    jobs = []
+
+    for nr in range(n_games):
+        opening = openings[(nr // 2) % len(openings)]
+        jobs.append((nr + 1, opening, engines, nr % 2, limits, max_moves))
+
+    if sprt:
+        elo0, elo1, alpha, beta = sprt
+        llr_lo = math.log(beta / (1.0 - alpha))
+        llr_hi = math.log((1.0 - beta) / alpha)
+
+    w = d = l = 0
+
+    pgn_fh = open(pgn_file, 'a') if pgn_file else None
+
+    ctx = multiprocessing.get_context('spawn')
+
+    n_workers = max(1, min(concurrency, n_games))
+
+    # games are handed out one at a time so that after an SPRT decision
+    # no new ones start; the running ones finish and quit their engines
+    done = queue.Queue()
+    next_job = 0
+    running = 0
+    decided = False
+
+    with ctx.Pool(n_workers) as pool:
+        while running or (next_job < len(jobs) and not decided):
+            while not decided and next_job < len(jobs) and running < n_workers:
+                pool.apply_async(play_game, (jobs[next_job],), callback=done.put, error_callback=done.put)
+                next_job += 1
+                running += 1
+
+            r = done.get()
+            running -= 1
+
+            if isinstance(r, Exception):
+                raise r
+
+            nr, white, result, pgn = r
+
+            if result == '1/2-1/2':
+                d += 1
+
+            elif (result == '1-0') == (white == 0):
+                w += 1
+
+            else:
+                l += 1
+
+            if pgn_fh:
+                pgn_fh.write(pgn + '\n\n')
+                pgn_fh.flush()
+
+            diff, margin = elo(w, d, l)
+
+            msg = 'game %d/%d: %s (%s white) +%d -%d =%d, elo %.1f +- %.1f' % (w + d + l, n_games, result, engines[white][2], w, l, d, diff, margin)
+
+            if sprt:
+                llr = sprt_llr(w, d, l, elo0, elo1)
+                msg += ', llr %.2f (%.2f, %.2f)' % (llr, llr_lo, llr_hi)
+
+            print(msg)
+            sys.stdout.flush()
+
+            if sprt and not decided and (llr <= llr_lo or llr >= llr_hi):
+                print('SPRT: %s accepted' % ('H1' if llr >= llr_hi else 'H0'))
+                sys.stdout.flush()
+
+                decided = True
+
+    if pgn_fh:
+        pgn_fh.close()
+
+    return (w, d, l)
+
+if __name__ == '__main__':
+    cmds = [ None, None ]
+    options = [ [], [] ]
+    openings_file = None
+    n_games = 100
+    concurrency = os.cpu_count() or 1
+    limits = {}
+    pgn_file = None
+    sprt = None
+    alpha = beta = 0.05
+    max_moves = match_max_moves
+
+    args = sys.argv[1:]
+
+    nr = 0
+    while nr < len(args):
+        if args[nr] == 'engine1' or args[nr] == 'engine2':
+            cmds[int(args[nr][-1]) - 1] = args[nr + 1]
+
+        elif args[nr] == 'option1' or args[nr] == 'option2':
+            options[int(args[nr][-1]) - 1].append(args[nr + 1])
+
+        elif args[nr] == 'openings':
+            openings_file = args[nr + 1]
+
+        elif args[nr] == 'games':
+            n_games = int(args[nr + 1])
+
+        elif args[nr] == 'concurrency':
+            concurrency = int(args[nr + 1])
+
+        elif args[nr] == 'tc':
+            base, inc = (args[nr + 1] + '+0').split('+')[0:2]
+            limits['tc'] = (float(base), float(inc))
+
+        elif args[nr] == 'movetime':
+            limits['movetime'] = int(args[nr + 1]) / 1000.0
+
+        elif args[nr] == 'nodes':
+            limits['nodes'] = int(args[nr + 1])
+
+        elif args[nr] == 'pgn':
+            pgn_file = args[nr + 1]
+
+        elif args[nr] == 'sprt':
+            sprt = (float(args[nr + 1]), float(args[nr + 2]))
+            nr += 1
+
+        elif args[nr] == 'alpha':
+            alpha = float(args[nr + 1])
+
+        elif args[nr] == 'beta':
+            beta = float(args[nr + 1])
+
+        elif args[nr] == 'maxmoves':
+            max_moves = int(args[nr + 1])
+
+        else:
+            print('unknown: %s' % args[nr])
+            sys.exit(1)
+
+        nr += 2
+
+    if not cmds[0] or not cmds[1]:
+        print('engine1 and engine2 are required')
+        sys.exit(1)
+
+    if not limits:
+        limits['movetime'] = 0.1
+
+    engines = [ parse_engine(cmds[i], options[i], 'engine%d' % (i + 1)) for i in range(2) ]
+
+    openings = load_openings(openings_file) if openings_file else [ (chess.STARTING_FEN, []) ]
+
+    w, d, l = run_match(engines, openings, n_games, concurrency, limits, pgn_file, sprt + (alpha, beta) if sprt else None, max_moves)
+
+    diff, margin = elo(w, d, l)
+    print('===========================')
+    print('Score of %s vs %s: +%d -%d =%d' % (engines[0][2], engines[1][2], w, l, d))
+    print('Elo difference  : %.1f +- %.1f' % (diff, margin))
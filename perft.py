@@ -0,0 +1,123 @@
+import math
+import multiprocessing
+import os
+import time
+from array import array
+from board import Board
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Move generator validation. Leaves are counted in bulk (number of legal
+# moves at depth 1 instead of making them), sub-trees are cached in a
+# (zobrist, depth) -> count table and the root moves can be divided over
+# a pool of processes.
+
+perft_hash_size = 1 << 20
+
+ph_keys = None
+ph_depths = None
+ph_counts = None
+
+def perft_hash_init(size):
+    """ a size of 0 (or None) disables the table; also the initializer
+        of the pool processes """
+    global perft_hash_size, ph_keys, ph_depths, ph_counts
+
+    if not size:
+        ph_keys = ph_depths = ph_counts = None
+        return
+
+    perft_hash_size = size
+
+    ph_keys = array('Q', [ 0 ]) * size
+    ph_depths = array('B', [ 0 ]) * size
+    ph_counts = array('Q', [ 0 ]) * size
+
+def perft(board, depth):
+    if depth <= 0:
+        return 1
+
+    if depth == 1:
+        return board.legal_moves.count()
+
+    if ph_keys:
+        h = board.get_zh()
+        idx = (h + depth) % perft_hash_size
+
+        if ph_keys[idx] == h and ph_depths[idx] == depth:
+            return ph_counts[idx]
+
+    total = 0
+
+    for m in board.generate_legal_moves():
+        board.push(m)
+        total += perft(board, depth - 1)
+        board.pop()
+
+    if ph_keys:
+        ph_keys[idx] = h
+        ph_depths[idx] = depth
+        ph_counts[idx] = total
+
+    return total
+
+def perft_root_move(args):
+    """ runs in a pool process: count the tree below one root move """
+    fen, uci, depth = args
+
+    board = Board(fen)
+    board.push_uci(uci)
+
+    return perft(board, depth - 1)
+
+def run_perft(board, depth, divide=False, processes=None, hash_size=perft_hash_size):
+    """ 'perft'/'divide' command; returns the node count """
+    if depth < 1:
+        print('Nodes searched  : 1')
+        return 1
+
+    if processes == None:
+        processes = os.cpu_count() or 1
+
+    start = time.time()
+
+    moves = list(board.generate_legal_moves())
+
+    # not worth starting processes for small trees
+    if processes > 1 and depth > 3 and len(moves) > 1:
+        jobs = [ (board.fen(), m.uci(), depth) for m in moves ]
+
+        ctx = multiprocessing.get_context('spawn')
+        with ctx.Pool(min(processes, len(moves)), perft_hash_init, (hash_size,)) as pool:
+            counts = pool.map(perft_root_move, jobs)
+
+    else:
+        if hash_size and ph_keys == None:
+            perft_hash_init(hash_size)
+
+        counts = []
+
+        for m in moves:
+            board.push(m)
+            counts.append(perft(board, depth - 1))
+            board.pop()
+
+    total = 0
+
+    for m, cnt in zip(moves, counts):
+        if divide:
+            print('%s: %d' % (m.uci(), cnt))
+
+        total += cnt
+
+    took = time.time() - start
+
+    if divide:
+        print('===========================')
+
+    print('Total time (ms) : %d' % math.ceil(took * 1000.0))
+    print('Nodes searched  : %d' % total)
+    print('Nodes/second    : %d' % math.floor(total / took if took > 0 else 0))
+
+    return total
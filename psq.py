@@ -3,6 +3,14 @@ import chess
 # (C) 2017 by folkert@vanheusden.com
 # released under AGPL v3.0
 
+pmaterial_table = [ 0 ] * (6 + 1)
+pmaterial_table[chess.PAWN] = 100
+pmaterial_table[chess.KNIGHT] = 325
+pmaterial_table[chess.BISHOP] = 325
+pmaterial_table[chess.ROOK] = 500
+pmaterial_table[chess.QUEEN] = 975
+pmaterial_table[chess.KING] = 10000
+
 psq_table = [ None ] * (6 + 1)
 
 psq_table[chess.PAWN] = [
@@ -66,6 +74,17 @@ psq_table[chess.KING] = [
      20, 20,  0,  0,  0,  0, 20, 20,
      20, 30, 10,  0,  0, 10, 30, 20 ]
 
+# psq_color_table[color][piece_type][square], used by the incremental
+# updates in board.py
+psq_color_table = [ [ None ] * (6 + 1), [ None ] * (6 + 1) ]
+
+def psq_init_color_table():
+    for piece_type in range(chess.PAWN, chess.KING + 1):
+        psq_color_table[chess.BLACK][piece_type] = list(psq_table[piece_type])
+        psq_color_table[chess.WHITE][piece_type] = [ psq_table[piece_type][chess.square_mirror(sq)] for sq in range(0, 64) ]
+
+psq_init_color_table()
+
 def psq_individual(pos, piece):
     global psq_table
 
@@ -0,0 +1,167 @@
+import multiprocessing
+import queue
+from board import Board
+from log import l, set_l_level
+from tt import tt_init, tt_attach, tt_detach, tt_get_shared, tt_get_age, tt_set_age
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Lazy SMP: helper processes run the same iterative deepening search as
+# the main thread, at staggered depths. They only cooperate through the
+# transposition table which lives in shared memory. Options that change
+# the search (evaluation cache size, tablebases) and the log level are
+# sent to the helpers too so that they behave like the main thread.
+
+smp_ctx = multiprocessing.get_context('spawn')
+
+workers = []
+task_queues = []
+result_queue = None
+stop_event = None
+search_id = 0
+
+# transposition table size of the processes of the pools in epdsolve.py
+# and annotate.py
+worker_hash_mb = 16
+
+# name -> value, see smp_apply_option()
+smp_options = {}
+
+def worker_init(hash_mb):
+    """ initializer of pool processes that search (with their own
+        transposition table) """
+    tt_init(hash_mb)
+
+def smp_apply_option(name, value):
+    import brain
+    import tb
+
+    if name == 'evalcache':
+        brain.ec_init(value)
+
+    elif name == 'syzygypath':
+        tb.tb_init(value)
+
+    elif name == 'syzygyprobelimit':
+        tb.tb_set_probe_limit(value)
+
+    elif name == 'loglevel':
+        set_l_level(value)
+
+def smp_worker(nr, tt_name, tt_size, options, task_q, result_q, stop_ev):
+    import brain
+
+    tt_attach(tt_name, tt_size)
+
+    for name, value in options.items():
+        smp_apply_option(name, value)
+
+    while True:
+        task = task_q.get()
+        if task == None:
+            break
+
+        if task[0] == 'option':
+            smp_apply_option(task[1], task[2])
+            continue
+
+        id_, fen, max_depth, age = task
+
+        board = Board(fen)
+        tt_set_age(age)
+
+        # odd helpers start one ply deeper so that not everybody searches
+        # the same depth at the same time
+        result = brain.helper_search(board, max_depth, 1 + nr % 2, stop_ev)
+
+        result_q.put((id_, nr) + result)
+
+    tt_detach()
+
+def smp_set_option(name, value):
+    """ remembers the option for helpers started later and passes it to
+        the running ones (they pick it up before their next search) """
+    smp_options[name] = value
+
+    for q in task_queues:
+        q.put(('option', name, value))
+
+def smp_shutdown():
+    global workers, task_queues
+
+    for q in task_queues:
+        q.put(None)
+
+    for p in workers:
+        p.join()
+
+    workers = []
+    task_queues = []
+
+def smp_init(n_threads, hash_mb):
+    """ (re-)creates the transposition table and, for n_threads > 1, the
+        helper processes sharing it """
+    global result_queue, stop_event
+
+    smp_shutdown()
+
+    if n_threads <= 1:
+        tt_init(hash_mb)
+        return
+
+    tt_init(hash_mb, shared=True)
+    name, size = tt_get_shared()
+
+    stop_event = smp_ctx.Event()
+    result_queue = smp_ctx.Queue()
+
+    for nr in range(1, n_threads):
+        q = smp_ctx.Queue()
+
+        p = smp_ctx.Process(target=smp_worker, args=(nr, name, size, dict(smp_options), q, result_queue, stop_event))
+        p.daemon = True
+        p.start()
+
+        workers.append(p)
+        task_queues.append(q)
+
+    l('started %d lazy smp helper processes', len(workers))
+
+def smp_search_start(board, max_depth):
+    global search_id
+
+    if not workers:
+        return
+
+    search_id += 1
+
+    stop_event.clear()
+
+    for q in task_queues:
+        q.put((search_id, board.fen(), max_depth, tt_get_age()))
+
+def smp_search_stop():
+    """ returns a list of (helper nr, depth, score, move, nodes) """
+    if not workers:
+        return []
+
+    stop_event.set()
+
+    results = []
+
+    while len(results) < len(workers):
+        try:
+            r = result_queue.get(True, 5.0)
+
+        except queue.Empty:
+            l('lazy smp helper did not respond')
+            break
+
+        # results of an earlier search
+        if r[0] != search_id:
+            continue
+
+        results.append(r[1:])
+
+    return results
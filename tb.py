@@ -0,0 +1,137 @@
+import chess
+import chess.syzygy
+import os
+from array import array
+from log import l
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Syzygy endgame tablebases (chess.syzygy). search() probes WDL for
+# positions with at most tb_probe_limit pieces, directly after a capture
+# or pawn move (then the 50 move counter can't change the outcome) and
+# without castling rights. The results are cached in a direct mapped
+# table keyed by the zobrist hash so that the files are not read again
+# for transpositions. At the root DTZ is used to select the moves that
+# keep the tablebase result.
+
+tb = None
+tb_probe_limit = 6
+tb_max_pieces = 0
+
+tb_cache_size = 65536
+tb_cache_keys = array('Q', [ 0 ]) * tb_cache_size
+tb_cache_wdl = array('b', [ 0 ]) * tb_cache_size
+
+TB_UNKNOWN = 127
+
+def tb_close():
+    global tb, tb_max_pieces
+
+    if tb:
+        tb.close()
+        tb = None
+
+    tb_max_pieces = 0
+
+def tb_init(path):
+    """ path: one or more directories separated by os.pathsep; empty (or
+        '<empty>') disables the tablebases """
+    global tb, tb_max_pieces
+
+    tb_close()
+    tb_cache_clear()
+
+    if not path or path == '<empty>':
+        return 0
+
+    tb = chess.syzygy.Tablebase()
+
+    n = 0
+    for d in path.split(os.pathsep):
+        try:
+            n += tb.add_directory(d)
+
+        except Exception as e:
+            l('cannot use tablebase directory %s: %s', d, e)
+
+    # table names are like KRPvKR
+    tb_max_pieces = max([ len(name) - 1 for name in tb.wdl ] + [ 0 ])
+
+    l('%d syzygy tables, up to %d pieces', n, tb_max_pieces)
+
+    if n == 0:
+        tb_close()
+
+    return n
+
+def tb_set_probe_limit(n):
+    global tb_probe_limit
+
+    tb_probe_limit = n
+
+def tb_cache_clear():
+    global tb_cache_keys, tb_cache_wdl
+
+    tb_cache_keys = array('Q', [ 0 ]) * tb_cache_size
+    tb_cache_wdl = array('b', [ 0 ]) * tb_cache_size
+
+def tb_can_probe(board):
+    if not tb or board.castling_rights:
+        return False
+
+    return chess.popcount(board.occupied) <= min(tb_probe_limit, tb_max_pieces)
+
+def tb_probe_wdl(board):
+    """ -2 (loss) .. 2 (win) for the side to move, None if unknown """
+    if not tb_can_probe(board):
+        return None
+
+    h = board.get_zh()
+    idx = h % tb_cache_size
+
+    if tb_cache_keys[idx] == h:
+        v = tb_cache_wdl[idx]
+
+    else:
+        v = tb.get_wdl(board)
+        if v == None:
+            v = TB_UNKNOWN
+
+        tb_cache_keys[idx] = h
+        tb_cache_wdl[idx] = v
+
+    return None if v == TB_UNKNOWN else v
+
+def tb_root_moves(board):
+    """ (wdl, moves): the moves that keep the tablebase result, the
+        best one (fastest zeroing for a win, slowest for a loss) first.
+        None when the root is not in the tablebases. """
+    if not tb_can_probe(board):
+        return None
+
+    scored = []
+
+    for m in board.legal_moves:
+        board.push(m)
+        wdl = tb.get_wdl(board)
+        dtz = tb.get_dtz(board)
+        board.pop()
+
+        if wdl == None or dtz == None:
+            return None
+
+        scored.append((-wdl, dtz, m))
+
+    if not scored:
+        return None
+
+    best = max(s[0] for s in scored)
+    keep = [ s for s in scored if s[0] == best ]
+
+    # the dtz of the opponent is negative when we win (closest to zero
+    # is fastest) and positive when we lose (highest is slowest)
+    if best != 0:
+        keep.sort(key=lambda s: -s[1])
+
+    return (best, [ s[2] for s in keep ])
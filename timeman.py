@@ -0,0 +1,193 @@
+import time
+from log import l
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Time management. A search gets a soft limit (the time we would like to
+# use) and a hard limit (the abort timer). After every completed
+# iteration the cost of the next one is predicted from the branching
+# factor of the previous iterations; an iteration that can't finish
+# before the hard limit is not started. The soft limit is stretched
+# while the best move keeps changing and shrunk when it is stable.
+#
+# Without a soft limit (a fixed time per move, e.g. 'go movetime') none
+# of this applies: the search only stops at the hard limit.
+#
+# The hard limit, a node limit and stop requests are in a SearchLimits
+# object. search()/qs() only compare their node counter with
+# next_check; the clock and the stop event are looked at every
+# poll_interval nodes.
+
+move_overhead = 50 # ms, reserved for gui/network lag
+
+poll_interval = 256
+
+tm_soft = None
+tm_hard = None
+tm_start = 0.0
+tm_iter_ts = []
+tm_best_move = None
+tm_stability = 0
+
+class SearchLimits:
+    def __init__(self, max_time=None, max_nodes=None, stop_event=None):
+        self.deadline = time.monotonic() + max_time if max_time else None
+        self.max_nodes = max_nodes
+        self.stop_event = stop_event
+
+        self.stopped = False
+        self.next_check = 0
+
+        # (soft, hard) of a ponderhit, and whether the time manager was
+        # started for this search (see cm_ponderhit())
+        self.ponderhit_times = None
+        self.tm_started = False
+
+    def stop(self):
+        """ can be called from an other thread """
+        self.stopped = True
+
+    def ponderhit(self, soft, hard):
+        """ a ponder search (no limits) gets a deadline """
+        self.deadline = time.monotonic() + hard if hard else None
+        self.next_check = 0
+
+        self.ponderhit_times = (soft, hard)
+
+    def check(self, nodes):
+        """ returns True when the search must stop """
+        if self.stop_event and self.stop_event.is_set():
+            self.stopped = True
+
+        elif self.deadline and time.monotonic() >= self.deadline:
+            l('time is up')
+            self.stopped = True
+
+        elif self.max_nodes and nodes >= self.max_nodes:
+            l('node limit reached')
+            self.stopped = True
+
+        self.next_check = nodes + poll_interval
+
+        # node limited searches stop at exactly max_nodes
+        if self.max_nodes:
+            self.next_check = min(self.next_check, self.max_nodes)
+
+        return self.stopped
+
+def tm_set_overhead(ms):
+    global move_overhead
+
+    move_overhead = max(0, ms)
+
+def tm_allocate(time_left, inc, movestogo, fullmove_number):
+    """ (soft, hard) in seconds for a clock with time_left/inc in ms """
+    left = max(time_left - move_overhead, 1) / 1000.0
+    inc /= 1000.0
+
+    if not movestogo:
+        # assume the game goes on for a while, less so later on
+        movestogo = max(20, 40 - fullmove_number // 2)
+
+    soft = left / movestogo + inc * 0.75
+    hard = min(soft * 4.0, left * 0.4 if movestogo > 1 else left * 0.8)
+
+    soft = min(soft, hard)
+
+    l('time left %f, inc %f, mtg %d: soft %f, hard %f', left, inc, movestogo, soft, hard)
+
+    return (soft, hard)
+
+def tm_movetime(movetime):
+    """ (soft, hard) for a fixed time per move in ms: there's no soft
+        limit, the whole time is used """
+    t = max(movetime - move_overhead, 1) / 1000.0
+
+    return (None, t)
+
+def tm_start_search(soft, hard):
+    global tm_soft, tm_hard, tm_start, tm_iter_ts, tm_best_move, tm_stability
+
+    tm_soft = soft
+    tm_hard = hard
+    tm_start = time.monotonic()
+    tm_iter_ts = [ 0.0 ]
+    tm_best_move = None
+    tm_stability = 0
+
+def tm_elapsed():
+    return time.monotonic() - tm_start
+
+def tm_predict_next():
+    """ expected duration of the next iteration """
+    n = len(tm_iter_ts)
+    if n < 2:
+        return 0.0
+
+    last = tm_iter_ts[-1] - tm_iter_ts[-2]
+
+    # effective branching factor of the last (up to) two iterations
+    factors = []
+    for i in range(max(2, n - 2), n):
+        prev = tm_iter_ts[i - 1] - tm_iter_ts[i - 2]
+        if prev > 0.001:
+            factors.append((tm_iter_ts[i] - tm_iter_ts[i - 1]) / prev)
+
+    bf = sum(factors) / len(factors) if factors else 2.0
+
+    return last * min(max(bf, 1.5), 8.0)
+
+def tm_iteration_done(move):
+    """ called after a completed iteration, returns False when the next
+        one should not be started """
+    global tm_best_move, tm_stability
+
+    now = tm_elapsed()
+    tm_iter_ts.append(now)
+
+    if move == tm_best_move:
+        tm_stability += 1
+
+    else:
+        tm_best_move = move
+        tm_stability = 0
+
+    return tm_worth_it(now, tm_predict_next())
+
+def tm_worth_it(start, predicted):
+    """ should an iteration that starts (or started) at 'start' and
+        takes 'predicted' seconds be searched """
+    # no limit or a fixed time: the deadline in SearchLimits decides
+    if tm_hard == None or tm_soft == None:
+        return True
+
+    # would be aborted halfway, a waste of time
+    if start + predicted > tm_hard:
+        return False
+
+    # best move just changed: up to 1.5 * soft, stable for a long time:
+    # down to half of it
+    scale = max(0.5, 1.5 - 0.15 * tm_stability)
+
+    return start + predicted * 0.5 < min(tm_soft * scale, tm_hard)
+
+def tm_ponderhit(soft, hard):
+    """ puts a ponder search on the clock; the time spent pondering is
+        free. Returns False when the iterations completed so far are
+        enough and the search can stop right away. """
+    global tm_soft, tm_hard, tm_start, tm_iter_ts
+
+    shift = tm_elapsed()
+
+    tm_start += shift
+    tm_iter_ts = [ ts - shift for ts in tm_iter_ts ]
+
+    tm_soft = soft
+    tm_hard = hard
+
+    if len(tm_iter_ts) < 2:
+        return True
+
+    # the running iteration started at tm_iter_ts[-1] (before now)
+    return tm_worth_it(tm_iter_ts[-1], tm_predict_next())
@@ -1,119 +1,361 @@
 import chess
 import chess.polyglot
-import copy
+import mmap
+import os
+import struct
+from array import array
 from log import l
+from multiprocessing import shared_memory
 
 # (C) 2017 by folkert@vanheusden.com
 # released under AGPL v3.0
 
-tt = []
+# The table is one flat array of 64 bit words. Every entry takes two
+# words: the zobrist key xor-ed with the data word, and the packed data
+# word itself. The xor makes torn writes by concurrent (lazy smp)
+# searchers detectable: such entries simply don't match on lookup.
+# Entries are grouped in buckets of tt_sub_size consecutive entries.
+#
+# data word layout (lsb first):
+#   score  20 bits (biased by TT_SCORE_BIAS)
+#   flags   2 bits
+#   depth   8 bits
+#   age     8 bits
+#   move   16 bits (from 6, to 6, promotion 3; 0 = no move)
+#
+# The table can be saved to/loaded from a file (savett/loadtt) or live
+# in a memory mapped file (HashFile option) so that it survives a
+# restart. Such a file starts with a header of tt_header_bytes: magic,
+# format version, number of buckets, bucket size and age.
+
+TT_UPPER = 1
+TT_LOWER = 2
+TT_EXACT = 3
+
+TT_SCORE_BIAS = 1 << 19
+
+tt = array('Q')
 tt_size = 0
 tt_sub_size = 8
 tt_age = 0
 
-class tt_element(object):
-    __slots__ = [ 'hash_', 'score', 'flags', 'depth', 'age', 'move' ]
+# bytes zeroed at a time by tt_clear()
+tt_clear_chunk = 1 << 20
 
-    def __init__(self, hash_, score, flags, depth, age, move):
-        self.hash_ = hash_
-        self.score = score
-        self.flags = flags
-        self.depth = depth
-        self.age = age
-        self.move = move
+tt_entry_bytes = 16
 
-def tt_init(size):
-    global tt_size, tt_sub_size, tt
+# set when the table lives in shared memory (see smp.py)
+tt_shm = None
+tt_shm_attached = None
+
+tt_magic = b'FeeksTT\0'
+tt_version = 1
+tt_header = struct.Struct('<8sQQQQ')
+tt_header_bytes = 64
+
+# memory mapped file backing the table (HashFile)
+tt_file = None
+tt_file_fh = None
+tt_file_mm = None
+
+def tt_release():
+    global tt, tt_shm
+
+    if tt_file_mm:
+        tt_header.pack_into(tt_file_mm, 0, tt_magic, tt_version, tt_size, tt_sub_size, tt_age)
+
+    tt = array('Q')
+
+    if tt_shm:
+        tt_shm.close()
+        tt_shm.unlink()
+        tt_shm = None
+
+    tt_unmap_file()
+
+def tt_set_file(path):
+    """ back the table by a memory mapped file from the next tt_init()
+        on; an empty path (or '<empty>') goes back to plain memory """
+    global tt_file
+
+    tt_file = path if path and path != '<empty>' else None
+
+def tt_read_header(data):
+    """ (buckets, bucket size, age) or None when not a (compatible)
+        table """
+    if len(data) < tt_header.size:
+        return None
+
+    magic, version, size, sub_size, age = tt_header.unpack_from(data, 0)
+
+    if magic != tt_magic or version != tt_version or sub_size != tt_sub_size:
+        return None
+
+    return (size, sub_size, age)
+
+def tt_map_file(path, size):
+    """ returns a table of size buckets in the mapped file and the age
+        it was stored with; the contents are kept when the file has a
+        table of the same size """
+    global tt_file_fh, tt_file_mm
+
+    n_bytes = tt_header_bytes + size * tt_sub_size * tt_entry_bytes
+
+    tt_file_fh = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+
+    header = tt_read_header(tt_file_fh.read(tt_header.size))
+    warm = header != None and header[0] == size and os.path.getsize(path) == n_bytes
+
+    if not warm:
+        # wipe and (re-)size
+        tt_file_fh.truncate(0)
+        tt_file_fh.truncate(n_bytes)
+
+    tt_file_mm = mmap.mmap(tt_file_fh.fileno(), n_bytes)
+
+    if not warm:
+        tt_header.pack_into(tt_file_mm, 0, tt_magic, tt_version, size, tt_sub_size, 0)
+
+    l('TT file %s: %s', path, 'reusing stored table' if warm else 'new table')
+
+    return (memoryview(tt_file_mm)[tt_header_bytes:].cast('Q'), header[2] if warm else 0)
+
+def tt_unmap_file():
+    global tt_file_fh, tt_file_mm
+
+    if tt_file_mm:
+        tt_file_mm.flush()
+        tt_file_mm.close()
+        tt_file_mm = None
+
+    if tt_file_fh:
+        tt_file_fh.close()
+        tt_file_fh = None
+
+def tt_init(size_mb, shared=False):
+    """ with tt_file set, the table is in that file; it is shared by
+        nature then """
+    global tt_size, tt_sub_size, tt, tt_shm, tt_age
+
+    # release the old table before allocating the new one
+    tt_release()
+
+    n_entries = size_mb * 1024 * 1024 // tt_entry_bytes
+    tt_size = max(1, n_entries // tt_sub_size)
+
+    l('Set TT size to %d MB, %d buckets of %d entries%s', size_mb, tt_size, tt_sub_size, ' (shared)' if shared else '')
+
+    n_words = tt_size * tt_sub_size * 2
+
+    if tt_file:
+        tt, tt_age = tt_map_file(tt_file, tt_size)
+
+    elif shared:
+        tt_shm = shared_memory.SharedMemory(create=True, size=n_words * 8)
+        tt = tt_shm.buf.cast('Q')
+
+    else:
+        tt = array('Q', [ 0 ]) * n_words
+
+def tt_attach(name, size):
+    """ attach to a table created by tt_init(..., shared=True) in an
+        other process """
+    global tt_size, tt, tt_shm_attached
 
-    l('Set TT size to %d entries ' % size)
     tt_size = size
 
-    dummy_move = chess.Move(0, 0)
+    if name.startswith('file:'):
+        tt, age = tt_map_file(name[5:], size)
+        return
+
+    tt_shm_attached = shared_memory.SharedMemory(name=name)
+    tt = tt_shm_attached.buf.cast('Q')
 
-    tt = [[tt_element(None, None, None, -1, -1, None) for i in range(tt_sub_size)] for i in range(tt_size)]
+def tt_detach():
+    global tt, tt_shm_attached
+
+    tt = array('Q')
+
+    tt_unmap_file()
+
+    if tt_shm_attached:
+        tt_shm_attached.close()
+        tt_shm_attached = None
+
+def tt_get_shared():
+    """ (name, size) of a shared table, None if not shared """
+    if tt_file_mm:
+        return ('file:' + tt_file, tt_size)
+
+    if not tt_shm:
+        return None
+
+    return (tt_shm.name, tt_size)
+
+def tt_set_age(age):
+    global tt_age
+
+    tt_age = age
+
+def tt_get_age():
+    return tt_age
+
+def tt_clear():
+    global tt, tt_age
+
+    # in place: a second table of the same size would double the memory
+    b = memoryview(tt).cast('B')
+    zeros = bytes(min(tt_clear_chunk, len(b)))
+
+    for i in range(0, len(b), len(zeros)):
+        n = min(len(zeros), len(b) - i)
+        b[i:i + n] = zeros[0:n]
+
+    b.release()
+
+    tt_age = 0
 
 def tt_inc_age():
     global tt_age
 
-    tt_age += 1
+    tt_age = (tt_age + 1) & 255
 
 def tt_calc_slot(h):
     global tt_size
 
     return h % tt_size
 
+def tt_pack_move(move):
+    if not move:
+        return 0
+
+    return move.from_square | (move.to_square << 6) | ((move.promotion or 0) << 12)
+
+def tt_unpack_move(v):
+    if v == 0:
+        return None
+
+    return chess.Move(v & 63, (v >> 6) & 63, (v >> 12) or None)
+
 def tt_store(board, alpha, beta, score, move, depth):
     global tt_sub_size, tt, tt_age
 
     if score <= alpha:
-        flags = 'U'
+        flags = TT_UPPER
     elif score >= beta:
-        flags = 'L'
+        flags = TT_LOWER
     else:
-        flags = 'E'
+        flags = TT_EXACT
+
+    if depth > 255:
+        depth = 255
 
     h = board.get_zh()
-    idx = tt_calc_slot(h)
+    base = tt_calc_slot(h) * tt_sub_size * 2
 
     use_ss = None
 
     use_ss2 = None
     min_depth = 99999
 
-    for i in range(0, tt_sub_size):
-        if tt[idx][i].hash_ == h:
-            if tt[idx][i].depth > depth:
+    for i in range(base, base + tt_sub_size * 2, 2):
+        data = tt[i + 1]
+
+        if tt[i] ^ data == h:
+            cur_depth = (data >> 22) & 255
+
+            if cur_depth > depth:
                 return
 
-            if flags != 'E' and tt[idx][i].depth == depth:
+            if flags != TT_EXACT and cur_depth == depth:
                 return
 
             use_ss = i
             break
 
-        if tt[idx][i].age != tt_age:
+        if use_ss is None and ((data >> 30) & 255) != tt_age:
             use_ss = i
-        elif tt[idx][i].depth < min_depth:
-            min_depth = tt[idx][i].depth
+
+        elif ((data >> 22) & 255) < min_depth:
+            min_depth = (data >> 22) & 255
             use_ss2 = i
 
-        if not use_ss:
-            use_ss = use_ss2
+    if use_ss is None:
+        use_ss = use_ss2
 
-    tt[idx][use_ss] = tt_element(h, score, flags, depth, tt_age, move)
+    data = (int(score) + TT_SCORE_BIAS) | (flags << 20) | (depth << 22) | (tt_age << 30) | (tt_pack_move(move) << 38)
+
+    tt[use_ss] = h ^ data
+    tt[use_ss + 1] = data
 
 def tt_lookup(board):
+    """ returns (score, flags, depth, move) or None """
     global tt_sub_size, tt
 
     h = board.get_zh()
-    idx = tt_calc_slot(h)
+    base = tt_calc_slot(h) * tt_sub_size * 2
+
+    for i in range(base, base + tt_sub_size * 2, 2):
+        data = tt[i + 1]
 
-    for i in range(0, tt_sub_size):
-        if tt[idx][i].hash_ == h:
-            if tt[idx][i].move == None or tt[idx][i].move in board.get_move_list():
-                return tt[idx][i]
+        if tt[i] ^ data == h:
+            move = tt_unpack_move(data >> 38)
+            if move == None or board.is_pseudo_legal(move):
+                return ((data & 0xfffff) - TT_SCORE_BIAS, (data >> 20) & 3, (data >> 22) & 255, move)
 
     return None
 
-def tt_get_pv(b, first_move):
-    pv = first_move.uci()
+def tt_save(path):
+    """ header followed by the raw table """
+    with open(path, 'wb') as fh:
+        header = bytearray(tt_header_bytes)
+        tt_header.pack_into(header, 0, tt_magic, tt_version, tt_size, tt_sub_size, tt_age)
 
-    board = b.copy()
-    board.push(first_move)
+        fh.write(header)
+        fh.write(tt)
 
-    hist = set()
+    l('TT saved to %s', path)
 
-    while True:
-        hit = tt_lookup(board)
-        if not hit or not hit.move:
-            break
+def tt_load(path):
+    """ returns False when the file is not a table of the current
+        size """
+    global tt_age
 
-        if hit.move in hist:
-            break
+    with open(path, 'rb') as fh:
+        header = tt_read_header(fh.read(tt_header_bytes))
+
+        if header == None or header[0] != tt_size:
+            l('%s: not a table of %d buckets', path, tt_size)
+            return False
+
+        n_bytes = len(tt) * 8
+
+        if os.fstat(fh.fileno()).st_size < tt_header_bytes + n_bytes:
+            l('%s: file is truncated', path)
+            return False
+
+        if fh.readinto(memoryview(tt).cast('B')) != n_bytes:
+            l('%s: short read', path)
+            tt_clear()
+            return False
+
+    tt_age = header[2]
+
+    l('TT loaded from %s', path)
+
+    return True
+
+def tt_hashfull():
+    """ permille of the first 1000 entries in use by the current search """
+    global tt, tt_age
 
-        pv += ' ' + hit.move.uci()
+    n = min(1000, len(tt) // 2)
+    if n == 0:
+        return 0
 
-        board.push(hit.move)
-        hist.add(hit.move)
+    used = 0
+    for i in range(0, n * 2, 2):
+        if tt[i] and ((tt[i + 1] >> 30) & 255) == tt_age:
+            used += 1
 
-    return pv
+    return used * 1000 // n
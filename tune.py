@@ -0,0 +1,335 @@
+#! /usr/bin/python
+
+# (C) 2017 by folkert@vanheusden.com
+# released under AGPL v3.0
+
+# Texel tuning of pmaterial_table and psq_table (psq.py).
+#
+# Labelled positions (a FEN followed by the game result: 1-0, 0-1,
+# 1/2-1/2 or 1.0, 0.0, 0.5, optionally quoted or in brackets) are read
+# in chunks. For every chunk the evaluation features are extracted once
+# into NumPy arrays (stored in a cache directory): per position the
+# piece count differences, +1/-1 per psq table entry in use and the
+# part of evaluate() that is not tuned. The optimizer then makes epochs
+# over the cached chunks with vectorized mini-batch gradient steps
+# (Adam) on the mean squared error between the result and
+# 1 / (1 + 10^(-k * eval / 400)). Memory use is bounded by the chunk
+# size (an int8 per weight per position, about 100 MB for the default
+# chunk), not by the number of positions; rows are only converted to
+# floats per mini-batch. The cache is only reused for the same input
+# file (path, size and modification time) and chunk size.
+#
+# Requires NumPy (pip install numpy); the engine itself doesn't.
+#
+# usage: tune.py <positions> [out <psq.py>] [epochs <n>] [lr <x>]
+#         [batch <n>] [chunk <n>] [cache <dir>] [k <x>]
+
+import chess
+import glob
+import math
+import numpy as np
+import os
+import re
+import sys
+import time
+import brain
+import psq
+from board import Board
+
+tune_pieces = [ chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING ]
+
+# weight vector: material of pawn..queen (the king is not tuned), then
+# 64 psq entries per piece type pawn..king
+n_material = 5
+n_weights = n_material + 6 * 64
+
+tune_results = { '1-0' : 1.0, '0-1' : 0.0, '1/2-1/2' : 0.5, '1.0' : 1.0, '0.0' : 0.0, '0.5' : 0.5, '1' : 1.0, '0' : 0.0 }
+
+def psq_index(piece_type, sq):
+    return n_material + (piece_type - 1) * 64 + sq
+
+def initial_weights():
+    w = np.zeros(n_weights, dtype=np.float64)
+
+    for piece_type in tune_pieces[0:n_material]:
+        w[piece_type - 1] = psq.pmaterial_table[piece_type]
+
+    for piece_type in tune_pieces:
+        for sq in range(64):
+            w[psq_index(piece_type, sq)] = psq.psq_table[piece_type][sq]
+
+    return w
+
+def parse_line(line):
+    """ (fen, result) or None """
+    fields = line.replace(';', ' ').replace('[', ' ').replace(']', ' ').replace('"', ' ').split()
+    if len(fields) < 5:
+        return None
+
+    result = None
+    for f in reversed(fields[4:]):
+        if f in tune_results:
+            result = tune_results[f]
+            break
+
+    if result == None:
+        return None
+
+    # board, turn, castling, e.p. (+ optional counters)
+    fen = ' '.join(fields[0:4])
+
+    return (fen, result)
+
+def extract_features(fen):
+    """ (features, fixed part of the evaluation), white relative """
+    board = Board(fen)
+
+    x = np.zeros(n_weights, dtype=np.int8)
+
+    for sq, p in board.piece_map().items():
+        sign = 1 if p.color == chess.WHITE else -1
+
+        if p.piece_type != chess.KING:
+            x[p.piece_type - 1] += sign
+
+        # psq_table is indexed from black's point of view
+        x[psq_index(p.piece_type, chess.square_mirror(sq) if p.color == chess.WHITE else sq)] += sign
+
+    passed, double, pawn_files = brain.pawn_structure(board)
+
+    fixed = passed - double * brain.double_pawn_penalty + brain.count_rooks_on_open_file(board, pawn_files) * brain.rook_open_file_bonus
+
+    return (x, fixed)
+
+def build_cache(file_, cache_dir, chunk_size):
+    """ extracts the features of all positions, chunk_size positions
+        per file in cache_dir; returns the list of chunk files """
+    os.makedirs(cache_dir, exist_ok=True)
+
+    st = os.stat(file_)
+    source = '%s %d %d %d\n' % (os.path.abspath(file_), st.st_size, st.st_mtime_ns, chunk_size)
+
+    source_file = os.path.join(cache_dir, 'source')
+
+    chunks = sorted(glob.glob(os.path.join(cache_dir, 'chunk-*.npz')))
+
+    if chunks and os.path.exists(source_file):
+        with open(source_file, 'r') as fh:
+            if fh.read() == source:
+                print('using %d cached chunks in %s' % (len(chunks), cache_dir))
+                return chunks
+
+    # stale: an other input file or a changed one
+    for name in chunks:
+        os.unlink(name)
+
+    if os.path.exists(source_file):
+        os.unlink(source_file)
+
+    chunks = []
+
+    X = np.zeros((chunk_size, n_weights), dtype=np.int8)
+    fixed = np.zeros(chunk_size, dtype=np.float32)
+    results = np.zeros(chunk_size, dtype=np.float32)
+
+    n = 0
+    total = 0
+
+    def flush():
+        name = os.path.join(cache_dir, 'chunk-%06d.npz' % len(chunks))
+        np.savez(name, X=X[0:n], fixed=fixed[0:n], results=results[0:n])
+        chunks.append(name)
+
+    with open(file_, 'r') as fh:
+        for line in fh:
+            entry = parse_line(line)
+            if entry == None:
+                continue
+
+            try:
+                X[n], fixed[n] = extract_features(entry[0])
+
+            except ValueError as e:
+                continue
+
+            results[n] = entry[1]
+            n += 1
+
+            if n == chunk_size:
+                flush()
+                total += n
+                n = 0
+
+                print('%d positions' % total)
+
+    if n:
+        flush()
+        total += n
+
+    # written last: an interrupted run leaves no valid cache
+    with open(source_file, 'w') as fh:
+        fh.write(source)
+
+    print('%d positions in %d chunks' % (total, len(chunks)))
+
+    return chunks
+
+def load_chunk(name):
+    """ X stays int8: only the rows that are used at a time are converted """
+    with np.load(name) as data:
+        return (data['X'], data['fixed'], data['results'])
+
+# rows converted to float at a time by chunk_eval()
+eval_rows = 16384
+
+def chunk_eval(X, fixed, ws):
+    """ evaluation of all positions of a chunk, ws = w * psq_scale() """
+    ev = np.empty(len(fixed), dtype=np.float64)
+
+    for i in range(0, len(fixed), eval_rows):
+        ev[i:i + eval_rows] = X[i:i + eval_rows].astype(np.float32) @ ws + fixed[i:i + eval_rows]
+
+    return ev
+
+def psq_scale():
+    """ evaluate() divides the psq sum by 4 """
+    s = np.ones(n_weights, dtype=np.float32)
+    s[n_material:] = 0.25
+
+    return s
+
+def error(chunks, w, k):
+    total = 0.0
+    n = 0
+
+    s = psq_scale()
+
+    for name in chunks:
+        X, fixed, results = load_chunk(name)
+
+        ev = chunk_eval(X, fixed, w * s)
+        p = 1.0 / (1.0 + np.power(10.0, -k * ev / 400.0))
+
+        total += float(np.sum((results - p) ** 2))
+        n += len(results)
+
+    return total / max(1, n)
+
+def find_k(chunks, w):
+    """ the k that fits the current evaluation best (golden section) """
+    lo, hi = 0.1, 3.0
+    g = (math.sqrt(5.0) - 1.0) / 2.0
+
+    a = hi - g * (hi - lo)
+    b = lo + g * (hi - lo)
+    ea = error(chunks, w, a)
+    eb = error(chunks, w, b)
+
+    for i in range(20):
+        if ea < eb:
+            hi, b, eb = b, a, ea
+            a = hi - g * (hi - lo)
+            ea = error(chunks, w, a)
+
+        else:
+            lo, a, ea = a, b, eb
+            b = lo + g * (hi - lo)
+            eb = error(chunks, w, b)
+
+    return (lo + hi) / 2.0
+
+def tune(chunks, w, k, epochs, lr, batch):
+    """ Adam over mini-batches, returns the tuned weights """
+    s = psq_scale()
+
+    m = np.zeros(n_weights)
+    v = np.zeros(n_weights)
+    beta1, beta2, eps = 0.9, 0.999, 1e-8
+    t = 0
+
+    c = k * math.log(10.0) / 400.0
+
+    for epoch in range(epochs):
+        start = time.time()
+
+        for name in chunks:
+            X, fixed, results = load_chunk(name)
+
+            order = np.random.permutation(len(results))
+
+            for i in range(0, len(order), batch):
+                idx = order[i:i + batch]
+                Xb = X[idx].astype(np.float32)
+
+                ev = Xb @ (w * s) + fixed[idx]
+                p = 1.0 / (1.0 + np.exp(-c * ev))
+
+                # d mse / d w
+                g = (-2.0 * c / len(idx)) * (((results[idx] - p) * p * (1.0 - p)) @ Xb) * s
+
+                t += 1
+                m = beta1 * m + (1.0 - beta1) * g
+                v = beta2 * v + (1.0 - beta2) * g * g
+
+                w = w - lr * (m / (1.0 - beta1 ** t)) / (np.sqrt(v / (1.0 - beta2 ** t)) + eps)
+
+        print('epoch %d: error %.6f (%.1f s)' % (epoch + 1, error(chunks, w, k), time.time() - start))
+        sys.stdout.flush()
+
+    return w
+
+def format_table(values):
+    rows = []
+
+    for r in range(8):
+        rows.append('    ' + ','.join('%4d' % v for v in values[r * 8:r * 8 + 8]))
+
+    return ' [\n' + ',\n'.join(rows) + ' ]'
+
+def write_psq(w, template, out):
+    """ psq.py with the tables replaced by the tuned values """
+    with open(template, 'r') as fh:
+        text = fh.read()
+
+    names = { chess.PAWN : 'PAWN', chess.KNIGHT : 'KNIGHT', chess.BISHOP : 'BISHOP', chess.ROOK : 'ROOK', chess.QUEEN : 'QUEEN', chess.KING : 'KING' }
+
+    for piece_type in tune_pieces:
+        name = names[piece_type]
+
+        if piece_type != chess.KING:
+            text = re.sub(r'pmaterial_table\[chess\.%s\] = -?\d+' % name, 'pmaterial_table[chess.%s] = %d' % (name, int(round(w[piece_type - 1]))), text)
+
+        values = [ int(round(w[psq_index(piece_type, sq)])) for sq in range(64) ]
+        text = re.sub(r'psq_table\[chess\.%s\] = \[[^\]]*\]' % name, 'psq_table[chess.%s] =%s' % (name, format_table(values)), text)
+
+    with open(out, 'w') as fh:
+        fh.write(text)
+
+    print('tuned tables written to %s' % out)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print('usage: %s <positions> [out <psq.py>] [epochs <n>] [lr <x>] [batch <n>] [chunk <n>] [cache <dir>] [k <x>]' % sys.argv[0])
+        sys.exit(1)
+
+    args = { 'out' : 'psq-tuned.py', 'epochs' : '10', 'lr' : '1.0', 'batch' : '16384', 'chunk' : '262144', 'cache' : sys.argv[1] + '.cache', 'k' : None }
+
+    nr = 2
+    while nr + 1 < len(sys.argv):
+        if not sys.argv[nr] in args:
+            print('unknown: %s' % sys.argv[nr])
+            sys.exit(1)
+
+        args[sys.argv[nr]] = sys.argv[nr + 1]
+        nr += 2
+
+    chunks = build_cache(sys.argv[1], args['cache'], int(args['chunk']))
+
+    w = initial_weights()
+
+    k = float(args['k']) if args['k'] else find_k(chunks, w)
+    print('k = %f, initial error %.6f' % (k, error(chunks, w, k)))
+
+    w = tune(chunks, w, k, int(args['epochs']), float(args['lr']), int(args['batch']))
+
+    write_psq(w, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'psq.py'), args['out'])